@@ -22,9 +22,9 @@ from matplotlib.lines import Line2D
 from matplotlib.text import Text
 from matplotlib.collections import Collection, PathCollection
 from matplotlib.quiver import QuiverKey, Quiver
-import matplotlib.animation as animation
-from typing import List, Tuple
+from typing import Callable, List, Tuple
 from time import perf_counter
+from profiling import FrameStats
 
 
 artists = [Line2D, Collection, Text, QuiverKey, Quiver, PathCollection]
@@ -33,7 +33,7 @@ artists = [Line2D, Collection, Text, QuiverKey, Quiver, PathCollection]
 class Animator:
     """
     Abstract animation class that adds a small layer of abstraction
-    over the matplotlib animation functions and interfaces.
+    over the matplotlib timer and blitting interfaces.
 
     To use this class:
     -Inherit this in a derived class.
@@ -43,9 +43,23 @@ class Animator:
     -Update the plots inside the update method, which must be
      overriden.
     -Call the animation_loop method to show the animation.
+    -Call mark_dirty whenever the plots need to be redrawn. While
+     nothing is dirty no frames are drawn and the animation timer
+     is stopped, unless pause_when_idle is set to False.
+    -The plots are drawn over a saved background of everything else in
+     the figure. The background is drawn again only when the axes
+     limits, the titles or the size of the figure have changed,
+     so any number of changes to these within a frame cost one redraw.
+    -The time spent in each frame is recorded in self.stats. Time
+     spent elsewhere, such as in evaluating functions or handling
+     events, can be added to it with self.stats.measure.
 
     Attributes:
      figure [Figure]: Use this to obtain plot elements.
+     pause_when_idle [bool]: whether to stop drawing frames
+                             when nothing has changed.
+     frames_drawn [int]: the number of frames that were drawn.
+     stats [FrameStats]: the timings of the most recent frames.
     """
 
     def __init__(self, dpi: int,
@@ -66,12 +80,23 @@ class Animator:
                 figsize=figsize,
                 dpi=self.dots_per_inches
         )
-        self.main_animation = None
+        self.timer = None
+        self._timer_running = False
+        self.pause_when_idle = True
+        self.frames_drawn = 0
+        self.stats = FrameStats()
 
         # All private attributes.
+        self._dirty = True
+        self._frame_callbacks = []
         self._plots = []
         self._delta_t = 1.0/60.0
         self._t = perf_counter()
+        self._stats_text = None
+        self._background = None
+        # The state of everything that is in the background,
+        # when the background was saved.
+        self._background_key = None
 
     def add_plot(self, plot: plt.Artist) -> None:
         """
@@ -101,16 +126,119 @@ class Animator:
         """
         raise NotImplementedError
 
-    def _make_frame(self, i: int) -> list:
+    def add_frame_callback(self, callback: Callable[[], None]) -> None:
         """
-        Generate a single animation frame.
+        Add a function that is called at the start of every frame that
+        is drawn, before update. Input can be collected between frames
+        and applied here once per frame; call mark_dirty when there
+        is input so that the frame is drawn.
+
+        Parameters:
+         callback: called with no arguments.
+        """
+        self._frame_callbacks.append(callback)
+
+    def mark_dirty(self) -> None:
+        """
+        Request that the next animation frame is drawn,
+        restarting the animation timer if it was stopped.
+        """
+        self._dirty = True
+        if self.timer is not None and not self._timer_running:
+            # Starting a running timer would restart its interval,
+            # which events faster than the frame rate would keep
+            # doing so that no frame is drawn.
+            self.timer.start()
+            self._timer_running = True
+
+    def show_stats(self, show: bool = True) -> None:
+        """
+        Show or hide a text overlay in the corner of the first axes with
+        the frame rate, and the 50th, 95th and 99th percentiles of the
+        time spent in each stage of a frame.
+
+        Parameters:
+         show: whether to show the overlay.
+        """
+        if show and self._stats_text is None:
+            ax = self.figure.get_axes()[0]
+            self._stats_text = ax.text(
+                0.01, 0.99, "", transform=ax.transAxes, va="top",
+                family="monospace", fontsize=7, alpha=0.7)
+            if self.timer is not None:
+                self._stats_text.set_animated(True)
+                self._plots.append(self._stats_text)
+        elif not show and self._stats_text is not None:
+            if self._stats_text in self._plots:
+                self._plots.remove(self._stats_text)
+            self._stats_text.remove()
+            self._stats_text = None
+        self.mark_dirty()
+
+    def _make_frame(self) -> None:
         """
-        self.update(self._delta_t)
+        Generate and draw a single animation frame.
+        """
+        if self.pause_when_idle and not self._dirty:
+            # Nothing changed, so sleep until mark_dirty is called.
+            if self.timer is not None:
+                self.timer.stop()
+                self._timer_running = False
+            self._t = perf_counter()
+            return
+        if self.frames_drawn > 0:
+            # The previous frame ends here, having been drawn and
+            # followed by any events before this one.
+            self.stats.end_frame()
+        with self.stats.measure("events"):
+            for callback in self._frame_callbacks:
+                callback()
+        self._dirty = False
+        with self.stats.measure("update"):
+            self.update(self._delta_t)
+        if self._stats_text is not None:
+            self._stats_text.set_text(self.stats.summary())
+        with self.stats.measure("draw"):
+            if (self._background is None
+                    or self._get_background_key() != self._background_key):
+                # The draw_event handler saves the new background
+                # and draws the plots over it.
+                self.figure.canvas.draw()
+            else:
+                canvas = self.figure.canvas
+                canvas.restore_region(self._background)
+                self._draw_plots()
+                canvas.blit(self.figure.bbox)
+        self.frames_drawn += 1
         t = perf_counter()
         self._delta_t = t - self._t
         self._t = t
-        # print(self._plots)
-        return self._plots
+
+    def _get_background_key(self) -> tuple:
+        """
+        Get the state of everything in the background that can change.
+        """
+        return (tuple(self.figure.bbox.bounds),) + tuple(
+            (ax.get_xlim(), ax.get_ylim(), ax.get_title())
+            for ax in self.figure.get_axes())
+
+    def _draw_plots(self) -> None:
+        """
+        Draw the plots onto the canvas, without showing them.
+        """
+        for plot in self._plots:
+            self.figure.draw_artist(plot)
+
+    def _on_draw(self, event) -> None:
+        """
+        Save the background whenever the whole figure has been drawn,
+        which leaves out the plots since they are animated, and then
+        draw the plots over it.
+        """
+        canvas = self.figure.canvas
+        self._background = canvas.copy_from_bbox(self.figure.bbox)
+        self._background_key = self._get_background_key()
+        self._draw_plots()
 
     def _add_plots(self) -> None:
         """
@@ -131,71 +259,49 @@ class Animator:
 
     def animation_loop(self) -> None:
         """This method plays the animation. This must be called in order
-        for an animation to be shown.
+        for an animation to be shown, after the figure has been put
+        in the canvas that shows it.
         """
         self._add_plots()
-        self.main_animation = animation.FuncAnimation(
-                self.figure,
-                self._make_frame,
-                blit=True,
-                interval=self.animation_interval,
-                init_func=lambda *arg: []
-        )
+        for plot in self._plots:
+            plot.set_animated(True)
+        canvas = self.figure.canvas
+        canvas.mpl_connect("draw_event", self._on_draw)
+        self.timer = canvas.new_timer(interval=self.animation_interval)
+        self.timer.add_callback(self._make_frame)
+        self._dirty = True
+        self.timer.start()
+        self._timer_running = True
 
-    def toggle_blit(self) -> None:
-        """
-        If the animation is blitted remove the blitting,
-        otherwise add blitting to the animation. 
-        This is used so that it is possible to update the appearance of the 
-        plot title and axes, which would otherwise
-        be entirely static with blitting.
-        """
-        # TODO: Find a better way of updating the axes of the plot
-        # that uses blitting and does not access the
-        # protected members of the Animation class.
-        if self.main_animation._blit:
-            self.main_animation._blit_clear(
-                self.main_animation._drawn_artists, 
-                self.main_animation._blit_cache)
-            self.main_animation._blit = False
-        else:
-            # self.main_animation._init_draw()
-            self.main_animation._step()
-            self.main_animation._blit = True
-            self.main_animation._setup_blit()
-
-    def flush(self):
-        self.main_animation._blit_clear(
-                self.main_animation._drawn_artists, 
-                self.main_animation._blit_cache)
-        self.main_animation._step()
-    
-    def scale_axes(self, ax, 
+    def scale_axes(self, ax,
                    x_scale_factor: float,
-                   y_scale_factor: float) -> None:
+                   y_scale_factor: float,
+                   centre: Tuple[float, float] = None) -> None:
         """
         Enlarge or reduce the range of the axes of the plots,
-        with respect to the centre of the plot.
+        with respect to a point that stays where it is, which is
+        the centre of the plot unless given.
 
         Parameters:
-         ax: the AxesSubplot object to modify. 
+         ax: the AxesSubplot object to modify.
          x_scale_factor [float]: scale the x axes.
          y_scale_factor [float]: scale the y axes.
+         centre: the point to scale about, in plot coordinates.
         """
         xlim = ax.get_xlim()
         ylim = ax.get_ylim()
-        dx = xlim[1] - xlim[0]
-        dy = ylim[1] - ylim[0]
-        xc = (xlim[1] + xlim[0])/2
-        yc = (ylim[1] + ylim[0])/2
-        xlim = [xc - x_scale_factor*dx/2.0, xc + x_scale_factor*dx/2.0]
-        ylim = [yc - y_scale_factor*dy/2.0, yc + y_scale_factor*dy/2.0]
-        self.toggle_blit()
+        if centre is None:
+            centre = ((xlim[1] + xlim[0])/2, (ylim[1] + ylim[0])/2)
+        xc, yc = centre
+        xlim = [xc + x_scale_factor*(xlim[0] - xc),
+                xc + x_scale_factor*(xlim[1] - xc)]
+        ylim = [yc + y_scale_factor*(ylim[0] - yc),
+                yc + y_scale_factor*(ylim[1] - yc)]
         ax.set_xlim(xlim)
         ax.set_ylim(ylim)
-        self.toggle_blit()
+        self.mark_dirty()
 
-    def move_axes(self, ax, 
+    def move_axes(self, ax,
                   move_by_x: float, move_by_y: float) -> None:
         """
         Translate the x and y axes.
@@ -211,7 +317,6 @@ class Animator:
                 xlim[1] + move_by_x]
         ylim = [ylim[0] + move_by_y,
                 ylim[1] + move_by_y]
-        self.toggle_blit()
         ax.set_xlim(xlim)
         ax.set_ylim(ylim)
-        self.toggle_blit()
+        self.mark_dirty()
@@ -0,0 +1,466 @@
+# Copyright (C) 2020 Mark (marl0ny)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Alternative ways of evaluating functions over numpy arrays,
+used by FunctionRtoR in place of the function generated by lambdify.
+The numexpr backend is optional, and is only used
+if numexpr is installed.
+"""
+import ast
+import inspect
+import threading
+import numpy as np
+from collections import Counter
+from sympy import Symbol
+from sympy.core import basic
+from sympy.printing.lambdarepr import NumExprPrinter
+from typing import Any, Callable, Dict, List, Union
+from evaluation import bucket_size
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+# Binary operators and the numpy ufuncs that numpy arrays use for them.
+binary_ufuncs = {
+    ast.Add: "add", ast.Sub: "subtract", ast.Mult: "multiply",
+    ast.Div: "true_divide", ast.FloorDiv: "floor_divide",
+    ast.Mod: "remainder",
+}
+
+# Exponents for which numpy arrays use a cheaper ufunc than power.
+power_ufuncs = {2: "square", 0.5: "sqrt", -1: "reciprocal", 1: "positive"}
+
+
+class BufferedEvaluator:
+    """
+    Evaluate the function generated by lambdify over an array without
+    allocating a new array for every intermediate result. Sub
+    expressions that appear more than once are evaluated once,
+    operations on parameters alone are done on scalars, and the
+    remaining operations are done with in-place numpy ufuncs
+    on a small pool of work buffers that is kept between calls.
+
+    Since the code is generated from the source code of the lambdify
+    function, the same ufuncs are applied to the same operands in the
+    same order, so the results are identical to those of the
+    lambdify function.
+
+    Attributes:
+     source [str]: the generated Python code.
+     number_of_buffers [int]: the number of work buffers needed.
+
+    >>> import numpy
+    >>> source = "def f(x, a):\\n    return a*sin(x)**2 + sin(x)\\n"
+    >>> f = BufferedEvaluator(source, {"sin": numpy.sin})
+    >>> out = np.empty(3)
+    >>> y = f(np.array([0.0, np.pi/2, -np.pi/2]), 2.0, out=out)
+    >>> y is out, out
+    (True, array([0., 3., 1.]))
+    >>> f.number_of_buffers
+    1
+
+    The arguments of functions other than ufuncs are never
+    evaluated into the output, which the function may
+    write to before it has read them.
+
+    >>> from primitives import between
+    >>> source = "def g(x, a):\\n    return between(2*x, a, 3*x)\\n"
+    >>> g = BufferedEvaluator(source, {"between": between})
+    >>> g(np.array([0.1, 1.0, 4.0]), -10.0)
+    array([1., 1., 1.])
+    """
+
+    def __init__(self, source: str, namespace: Dict[str, Any]) -> None:
+        """
+        The initializer. Raises NotImplementedError if the function
+        contains an operation that can't be evaluated in place.
+
+        Parameters:
+         source: the source code of a function generated by lambdify.
+         namespace: the globals of that function.
+        """
+        generator = _BufferedCodeGenerator(source, namespace)
+        self.source = generator.source
+        self.number_of_buffers = generator.number_of_buffers
+        namespace = dict(namespace)
+        namespace.setdefault("numpy", np)
+        exec(self.source, namespace)
+        self._evaluate = namespace["_evaluate"]
+        self._local = threading.local()
+
+    def _get_buffers(self, shape: tuple) -> list:
+        """
+        Get the work buffers of the current thread, reallocating
+        them only if the shape of the input changed, or for 1D input,
+        if its length moved to another bucket_size.
+        """
+        if len(shape) == 1:
+            # Allocate 1D buffers a bucket at a time, so that small
+            # changes in the number of points don't reallocate them.
+            alloc_shape = (bucket_size(shape[0]),)
+        else:
+            alloc_shape = shape
+        buffers = getattr(self._local, "buffers", [])
+        if len(buffers) != self.number_of_buffers or \
+                (buffers != [] and buffers[0].shape != alloc_shape):
+            buffers = [np.empty(alloc_shape)
+                       for _ in range(self.number_of_buffers)]
+            self._local.buffers = buffers
+        if alloc_shape != shape:
+            return [b[: shape[0]] for b in buffers]
+        return buffers
+
+    def __call__(self, x: np.ndarray, *args: float,
+                 out: np.ndarray = None) -> np.ndarray:
+        """
+        Evaluate the function.
+
+        Parameters:
+         x: values of the main variable.
+         args: values of the parameters.
+         out: optional array for the output.
+
+        Returns:
+         The output array.
+        """
+        if out is None:
+            out = np.empty(x.shape)
+        self._evaluate(x, *args, self._get_buffers(x.shape), out)
+        return out
+
+
+class _BufferedCodeGenerator:
+    """
+    Generates the code used by BufferedEvaluator.
+    """
+
+    def __init__(self, source: str, namespace: Dict[str, Any]) -> None:
+        """
+        Generate the code from the source of a lambdify function.
+        """
+        function_def = ast.parse(source).body[0]
+        args = [arg.arg for arg in function_def.args.args]
+        self._namespace = namespace
+        self._arrays = {args[0]}
+        self._free = []
+        self._lines = []
+        self._counts = Counter()
+        self._held = {}
+        self._pending = []
+        self.number_of_buffers = 0
+        for statement in function_def.body:
+            if isinstance(statement, ast.Assign):
+                name = statement.targets[0]
+                if not isinstance(name, ast.Name):
+                    raise NotImplementedError("unpacking assignment")
+                if self._is_array(statement.value):
+                    self._count(statement.value)
+                    buffer = self._acquire()
+                    self._emit(statement.value, buffer)
+                    self._line("%s = %s" % (name.id, buffer))
+                    self._arrays.add(name.id)
+                else:
+                    self._line("%s = %s" % (name.id,
+                                            ast.unparse(statement.value)))
+            elif isinstance(statement, ast.Return):
+                if self._is_array(statement.value):
+                    self._count(statement.value)
+                    self._emit(statement.value, "_out")
+                else:
+                    self._line("_out[...] = %s"
+                               % ast.unparse(statement.value))
+            else:
+                raise NotImplementedError(type(statement).__name__)
+        header = ["def _evaluate(%s, _buffers, _out):"
+                  % ", ".join(args)]
+        if self.number_of_buffers > 0:
+            header.append("    %s, = _buffers" % ", ".join(
+                "_b%d" % i for i in range(self.number_of_buffers)))
+        self.source = "\n".join(header + ["    " + line for line
+                                          in self._lines]) + "\n"
+
+    def _line(self, line: str) -> None:
+        """
+        Add a line of code.
+        """
+        self._lines.append(line)
+
+    def _acquire(self) -> str:
+        """
+        Get a free work buffer.
+        """
+        if self._free != []:
+            return self._free.pop()
+        self.number_of_buffers += 1
+        return "_b%d" % (self.number_of_buffers - 1)
+
+    def _release(self, buffer: Union[str, None]) -> None:
+        """
+        Return a work buffer to the pool.
+        """
+        if buffer is not None:
+            self._free.append(buffer)
+
+    def _is_array(self, node: ast.AST) -> bool:
+        """
+        Whether a node depends on the main variable.
+        """
+        return any(isinstance(n, ast.Name) and n.id in self._arrays
+                   for n in ast.walk(node))
+
+    def _count(self, node: ast.AST) -> None:
+        """
+        Count how many times each array valued sub expression
+        is evaluated, not descending into repeated sub expressions
+        since those are only evaluated once.
+        """
+        if not self._is_array(node) or isinstance(node, ast.Name):
+            return
+        key = ast.dump(node)
+        self._counts[key] += 1
+        if self._counts[key] == 1:
+            for child in ast.iter_child_nodes(node):
+                self._count(child)
+
+    def _resolve(self, node: ast.AST) -> Union[Callable, None]:
+        """
+        Find the function that is called by a Call node.
+        """
+        if isinstance(node, ast.Name):
+            return self._namespace.get(node.id)
+        if isinstance(node, ast.Attribute):
+            value = self._resolve(node.value)
+            return getattr(value, node.attr, None)
+        return None
+
+    def _operand(self, node: ast.AST, target: str = None) -> str:
+        """
+        Get the code of an operand, evaluating it first if it is an
+        array that does not exist yet. A repeated sub expression is
+        kept in its own buffer until its last use. Otherwise, if target
+        is given the operand is evaluated into target, so that an
+        operation can then be done in place without another buffer.
+        """
+        if not self._is_array(node):
+            return "(%s)" % ast.unparse(node)
+        if isinstance(node, ast.Name):
+            return node.id
+        key = ast.dump(node)
+        if self._counts[key] <= 1 and target is not None:
+            self._emit_operation(node, target)
+            return target
+        if key in self._held:
+            buffer, uses = self._held[key]
+        else:
+            buffer, uses = self._acquire(), self._counts[key]
+            self._emit_operation(node, buffer)
+        if uses <= 1:
+            self._held.pop(key, None)
+            # Released once the operation using it has been written.
+            self._pending.append(buffer)
+        else:
+            self._held[key] = (buffer, uses - 1)
+        return buffer
+
+    def _emit(self, node: ast.AST, target: str) -> None:
+        """
+        Add the code that evaluates an array valued node into target.
+        """
+        operand = self._operand(node, target)
+        if operand != target:
+            self._line("numpy.copyto(%s, %s)" % (target, operand))
+        for buffer in self._pending:
+            self._release(buffer)
+        self._pending = []
+
+    def _emit_operation(self, node: ast.AST, target: str) -> None:
+        """
+        Add the code for the operation at the root of an array
+        valued node, writing the result into target.
+        """
+        pending, self._pending = self._pending, []
+        if isinstance(node, ast.BinOp) and type(node.op) in binary_ufuncs:
+            left, right = self._operands([node.left, node.right], target)
+            self._line("numpy.%s(%s, %s, out=%s)"
+                       % (binary_ufuncs[type(node.op)], left, right,
+                          target))
+        elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+            exponent = None
+            if not self._is_array(node.right):
+                try:
+                    exponent = ast.literal_eval(node.right)
+                except ValueError:
+                    pass
+            if self._is_array(node.left) and exponent in power_ufuncs:
+                self._line("numpy.%s(%s, out=%s)"
+                           % (power_ufuncs[exponent],
+                              self._operand(node.left, target), target))
+            else:
+                left, right = self._operands([node.left, node.right],
+                                             target)
+                self._line("numpy.power(%s, %s, out=%s)"
+                           % (left, right, target))
+        elif isinstance(node, ast.UnaryOp) and \
+                isinstance(node.op, (ast.USub, ast.UAdd)):
+            ufunc = "negative" if isinstance(node.op, ast.USub) \
+                else "positive"
+            self._line("numpy.%s(%s, out=%s)"
+                       % (ufunc, self._operand(node.operand, target),
+                          target))
+        elif isinstance(node, ast.Call) and node.keywords == []:
+            self._emit_call(node, target)
+        else:
+            raise NotImplementedError(
+                "%s can't be evaluated in place" % type(node).__name__)
+        for buffer in self._pending:
+            self._release(buffer)
+        self._pending = pending
+
+    def _operands(self, nodes: list, target: str) -> list:
+        """
+        Get the code of the operands of an operation, evaluating
+        the first array valued one into target.
+        """
+        codes = []
+        for node in nodes:
+            if target is not None and self._is_array(node):
+                codes.append(self._operand(node, target))
+                target = None
+            else:
+                codes.append(self._operand(node))
+        return codes
+
+    def _emit_call(self, node: ast.Call, target: str) -> None:
+        """
+        Add the code for a call to a ufunc or to a function
+        that accepts an out argument.
+        """
+        f = self._resolve(node.func)
+        if isinstance(f, np.ufunc):
+            if f.nin != len(node.args) or f.nout != 1:
+                raise NotImplementedError(f.__name__)
+        else:
+            try:
+                has_out = "out" in inspect.signature(f).parameters
+            except (TypeError, ValueError):
+                has_out = False
+            if not has_out:
+                raise NotImplementedError(
+                    "%s can't be evaluated in place"
+                    % ast.unparse(node.func))
+        # A ufunc reads each element of its inputs before writing it,
+        # so an input can share the output, but other functions
+        # may write to the output before reading all of an input.
+        args = self._operands(node.args,
+                              target if isinstance(f, np.ufunc) else None)
+        self._line("%s(%s, out=%s)" % (ast.unparse(node.func),
+                                       ", ".join(args), target))
+
+
+class _NumexprStringPrinter(NumExprPrinter):
+    """
+    Print an expression as a string for numexpr.evaluate.
+    Constants are printed as numbers, since numexpr has no math module,
+    and rationals as floats. Functions that numexpr doesn't have raise
+    a TypeError.
+    """
+
+    def _print_NumberSymbol(self, expr: basic.Basic) -> str:
+        return repr(float(expr))
+
+    _print_Pi = _print_Exp1 = _print_EulerGamma = _print_GoldenRatio = \
+        _print_NumberSymbol
+
+    def _print_Rational(self, expr: basic.Basic) -> str:
+        return repr(float(expr))
+
+    _print_Half = _print_Rational
+
+    def _print_not_supported(self, expr: basic.Basic) -> str:
+        raise TypeError("numexpr does not support %s"
+                        % type(expr).__name__)
+
+    _print_floor = _print_ceiling = _print_sign = _print_not_supported
+
+
+class NumexprEvaluator:
+    """
+    Evaluate an expression over an array with numexpr, which works
+    through the array in small blocks on several threads instead
+    of one whole array operation at a time.
+
+    Attributes:
+     expression [str]: the expression as given to numexpr.
+
+    >>> from sympy.parsing.sympy_parser import parse_expr
+    >>> x, a = Symbol("x"), Symbol("a")
+    >>> f = NumexprEvaluator(parse_expr("a*sin(pi*x)/2"), x, [a])
+    >>> f.expression
+    '(0.5)*v1*sin(3.141592653589793*v0)'
+    >>> bool(np.allclose(f(np.array([0.5, 1.5]), 4.0), [2.0, -2.0]))
+    True
+    """
+
+    def __init__(self, expr: basic.Basic, main_var: basic.Basic,
+                 parameters: List[basic.Basic]) -> None:
+        """
+        The initializer. Raises NotImplementedError if numexpr isn't
+        installed or if it can't evaluate the expression.
+
+        Parameters:
+         expr: the expression.
+         main_var: the main variable.
+         parameters: the parameters, in the order they are passed.
+        """
+        if numexpr is None:
+            raise NotImplementedError("numexpr is not installed")
+        if main_var not in expr.free_symbols:
+            raise NotImplementedError("constant expression")
+        symbols = [main_var] + list(parameters)
+        self._names = ["v%d" % i for i in range(len(symbols))]
+        expr = expr.xreplace({s: Symbol(name) for s, name
+                              in zip(symbols, self._names)})
+        try:
+            self.expression = _NumexprStringPrinter()._print(expr)
+            # Check that numexpr understands the expression.
+            with np.errstate(all="ignore"):
+                self(np.full(2, 0.5), *[1.0]*len(parameters))
+        except Exception as e:
+            raise NotImplementedError(str(e))
+
+    def __call__(self, x: np.ndarray, *args: float,
+                 out: np.ndarray = None) -> np.ndarray:
+        """
+        Evaluate the expression.
+
+        Parameters:
+         x: values of the main variable.
+         args: values of the parameters.
+         out: optional array for the output.
+
+        Returns:
+         The output array.
+        """
+        local_dict = dict(zip(self._names, (x,) + args))
+        return numexpr.evaluate(self.expression, local_dict=local_dict,
+                                out=out)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
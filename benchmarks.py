@@ -0,0 +1,179 @@
+# Copyright (C) 2020 Mark (marl0ny)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmarks for the function evaluation code.
+Run this file directly to print the results.
+"""
+import math
+import numpy as np
+from sympy import abc
+import functions
+from functions import FunctionRtoR, multiplies_var
+import primitives
+from time import perf_counter
+from typing import Callable
+
+
+def time_call(f: Callable, repeat: int = 1000) -> float:
+    """
+    Get the average time in seconds of calling f with no arguments.
+
+    Parameters:
+     f: the function to time.
+     repeat: the number of calls.
+    """
+    f()
+    t1 = perf_counter()
+    for _ in range(repeat):
+        f()
+    t2 = perf_counter()
+    return (t2 - t1)/repeat
+
+
+def benchmark_default_call_overhead() -> None:
+    """
+    Time calling a function with its default parameter values,
+    for expressions of increasing size. The overhead over calling the
+    compiled function directly should not depend on the size of
+    the expression. The previous behaviour, where the default values
+    were recomputed on every call, is shown for comparison.
+    """
+    print("Default parameter call overhead (us per call)")
+    print("%8s %12s %12s" % ("terms", "now", "recomputed"))
+    x = 0.5
+    for n in (1, 4, 16, 64):
+        function_name = " + ".join("a%d*sin(k%d*x)" % (i, i)
+                                   for i in range(n))
+        f = FunctionRtoR(function_name, abc.x)
+        d = f.get_default_values()
+        args = tuple(d[s] for s in f.parameters)
+        direct = time_call(lambda: f._lambda_func(x, *args))
+        now = time_call(lambda: f(x))
+
+        def recomputed():
+            d = {s: float(multiplies_var(f.symbols[0], s,
+                                         f._symbolic_func))
+                 for s in f.parameters}
+            return f._lambda_func(x, *(d[s] for s in d))
+        old = time_call(recomputed, 10)
+        print("%8d %12.2f %12.2f" % (n, 1e6*(now - direct),
+                                     1e6*(old - direct)))
+
+
+# Scalar versions of the primitives, evaluated one element at a time
+# with a list comprehension the way rect used to be.
+scalar_primitives = {
+    "rect": lambda v: 1.0 if v**2 <= 1.0 else 0.0,
+    "step": lambda v: 1.0 if v >= 0.0 else 0.0,
+    "triangle": lambda v: max(1.0 - abs(v), 0.0),
+    "sawtooth": lambda v: 2.0*((v/(2.0*math.pi)) % 1.0) - 1.0,
+    "square": lambda v: 1.0 if (v/(2.0*math.pi)) % 1.0 < 0.5 else -1.0,
+    "sinc": lambda v: math.sin(v)/v if v != 0.0 else 1.0,
+    "clamp": lambda v: min(max(v, -1.0), 1.0),
+    "between": lambda v: 1.0 if -1.0 <= v <= 1.0 else 0.0,
+    "ramp": lambda v: max(v, 0.0),
+}
+
+
+def benchmark_primitives(sizes: tuple = (10**3, 10**4, 10**5,
+                                         10**6, 10**7)) -> None:
+    """
+    Compare each vectorized primitive, with and without an out array,
+    against evaluating it one element at a time.
+
+    Parameters:
+     sizes: the numbers of points to evaluate at.
+    """
+    print("Primitives (ms per call)")
+    print("%10s %10s %12s %12s %12s" % ("function", "points",
+                                       "vectorized", "out=", "loop"))
+    extra_args = {"clamp": (-1.0, 1.0), "between": (-1.0, 1.0)}
+    for name, scalar_f in scalar_primitives.items():
+        f = getattr(primitives, name)
+        args = extra_args.get(name, ())
+        for n in sizes:
+            x = np.linspace(-10.0, 10.0, n)
+            out = np.empty(n)
+            repeat = max(1, 10**6//n)
+            vectorized = time_call(lambda: f(x, *args), repeat)
+            in_place = time_call(lambda: f(x, *args, out=out), repeat)
+            loop = time_call(lambda: np.array([scalar_f(v) for v in x]), 1)
+            print("%10s %10d %12.3f %12.3f %12.1f"
+                  % (name, n, 1e3*vectorized, 1e3*in_place, 1e3*loop))
+
+
+def benchmark_backends(n: int = 10**6) -> None:
+    """
+    Compare the evaluation backends for a few expressions, and show
+    which one the auto backend picks on first use.
+
+    Parameters:
+     n: the number of points to evaluate at.
+    """
+    print("Backends (ms per call, %d points)" % n)
+    print("%44s %10s %10s %10s %10s" % ("function", "lambdify", "cse",
+                                        "numexpr", "auto"))
+    x = np.linspace(-10.0, 10.0, n)
+    out = np.empty(n)
+    for function_name in ("a*sin(k*x)",
+                          "a*exp(-(x - b)**2/s**2)*cos(k*x - w)",
+                          "(x**3 - 2*x**2 + x - 1)/(x**2 + 1)",
+                          "a*sin(x)**2 + b*cos(x)**2 + c*sin(x)*cos(x)",
+                          "rect(x/a)*cos(k*x)"):
+        f = FunctionRtoR(function_name, abc.x)
+        times = []
+        for backend in functions.backends:
+            f.set_backend(backend)
+            times.append(time_call(lambda: f(x, out=out), 10))
+        choice = functions.backend_choices.get(f._source, "lambdify")
+        print("%44s %10.3f %10.3f %10.3f %10s"
+              % (function_name, *(1e3*t for t in times[:3]), choice))
+
+
+def benchmark_sweep(n: int = 1024) -> None:
+    """
+    Compare evaluating a function for every position of a slider
+    with a loop over the parameter values against a single sweep.
+
+    Parameters:
+     n: the number of points to evaluate at.
+    """
+    print("Parameter sweep (ms per sweep, %d points)" % n)
+    print("%10s %12s %12s" % ("curves", "loop", "sweep"))
+    f = FunctionRtoR("a*exp(-(x - b)**2/s**2)*cos(k*x - w)", abc.x)
+    x = np.linspace(-10.0, 10.0, n)
+    # The order of f.parameters isn't fixed, so the arguments
+    # are put in that order by name.
+    values = {"a": 1.0, "b": 0.0, "s": 1.0, "k": 1.0, "w": 2.0}
+    names = [str(p) for p in f.parameters]
+    for m in (10, 201, 2010):
+        a = np.linspace(-10.0, 10.0, m)
+
+        def args(a):
+            return [a if name == "a" else values[name] for name in names]
+
+        def loop():
+            return np.array([f(x, *args(v)) for v in a])
+        t_loop = time_call(loop, 5)
+        t_sweep = time_call(lambda: f.sweep(x, *args(a)), 5)
+        print("%10d %12.3f %12.3f" % (m, 1e3*t_loop, 1e3*t_sweep))
+
+
+if __name__ == "__main__":
+    benchmark_default_call_overhead()
+    benchmark_primitives()
+    benchmark_backends()
+    benchmark_sweep()
@@ -1,5 +1,23 @@
 config = {
     "function": "sin(x)", 
     "Number of points": 1024,
+    "Points per pixel": 2,
     "Plot Colour": "red",
-}
\ No newline at end of file
+    "Pause when idle": True,
+    "Function cache size": 64,
+    "Disk cache directory": "~/.cache/slidy-plotty-graphy",
+    "Disk cache size": 1 << 24,
+    "Threaded evaluation threshold": 1 << 17,
+    "Evaluation chunk size": 1 << 15,
+    "Evaluation backend": "auto",
+    "Symbolic timeout": 30.0,
+    "Sweep memory budget": 1 << 26,
+    "Slider prefetch": True,
+    "Slider prefetch memory": 1 << 26,
+    "Adaptive sampling": True,
+    "Maximum number of points": 1 << 14,
+    "Tile cache memory": 1 << 26,
+    "Asynchronous evaluation": True,
+    "Performance overlay": False,
+    "Frame stats file": "",
+}
@@ -0,0 +1,83 @@
+# Copyright (C) 2020 Mark (marl0ny)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Reducing large arrays of samples to what can be seen on screen
+before they are drawn.
+"""
+import numpy as np
+from typing import Tuple
+
+
+def m4_decimate(x: np.ndarray, y: np.ndarray, xlim: Tuple[float, float],
+                width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduce samples to at most four per pixel column: the first,
+    the smallest, the largest and the last value in the column.
+    A line drawn through these covers the same pixels as a line
+    drawn through all of the samples. Samples outside of xlim are
+    dropped, apart from the closest one on each side. A column that
+    contains NaN values is split at each of them, and each part is
+    reduced on its own, so that every break in the line remains.
+
+    Parameters:
+     x: the sampling points, in increasing order.
+     y: the values at the sampling points.
+     xlim: the visible range of x.
+     width: the width of the plot in pixels.
+
+    Returns:
+     The reduced sampling points and values. If there are not
+     more than four samples per column, x and y are returned as is.
+
+    >>> x = np.linspace(0.0, 1.0, 1001)
+    >>> xd, yd = m4_decimate(x, np.sin(50.0*x), (0.0, 1.0), 10)
+    >>> len(xd)
+    40
+    >>> float(np.amax(yd)) == float(np.amax(np.sin(50.0*x)))
+    True
+    >>> y = np.tan(20.0*x)
+    >>> y[np.abs(np.cos(20.0*x)) < 1e-2] = np.nan
+    >>> xd, yd = m4_decimate(x, y, (0.0, 1.0), 10)
+    >>> int(np.sum(np.diff(np.isnan(y).astype(int)) == 1))
+    6
+    >>> int(np.sum(np.diff(np.isnan(yd).astype(int)) == 1))
+    6
+    """
+    start = max(np.searchsorted(x, xlim[0], side="right") - 1, 0)
+    end = min(np.searchsorted(x, xlim[1], side="left") + 1, len(x))
+    if end - start <= 4*width:
+        return x, y
+    x, y = x[start: end], y[start: end]
+    # The index of the first sample in each pixel column, and
+    # the parts of the columns between NaN values.
+    edges = np.linspace(xlim[0], xlim[1], width + 1)[1: -1]
+    nan_indices = np.flatnonzero(np.isnan(y))
+    starts = np.unique(np.concatenate(
+        ([0], np.searchsorted(x, edges), nan_indices, nan_indices + 1)))
+    starts = starts[starts < len(x)]
+    ends = np.append(starts[1:], len(x)) - 1
+    with np.errstate(invalid="ignore"):
+        y_min = np.fmin.reduceat(y, starts)
+        y_max = np.fmax.reduceat(y, starts)
+    x_mid = 0.5*(x[starts] + x[ends])
+    xd = np.stack([x[starts], x_mid, x_mid, x[ends]], axis=-1).reshape(-1)
+    yd = np.stack([y[starts], y_min, y_max, y[ends]], axis=-1).reshape(-1)
+    return xd, yd
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,216 @@
+# Copyright (C) 2020 Mark (marl0ny)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Persistent on-disk store of compiled functions, so that
+functions used in a previous session do not need to be parsed,
+integrated or differentiated again by sympy.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import sympy
+from typing import Any, Dict, Union
+
+
+# Increment this whenever the layout of the stored entries changes.
+FORMAT_VERSION = 3
+
+
+class DiskCache:
+    """
+    A directory of JSON files, one per entry, keyed by a hash
+    of the entry key and the sympy version. Entries written by
+    another sympy version or with a different layout are ignored
+    and removed. When the total size of the directory exceeds
+    max_bytes, the least recently used entries are deleted.
+    The directory is created so that only its owner can use it, and
+    entries that others could have written are ignored, since
+    entries are parsed into sympy expressions.
+
+    Attributes:
+     directory [str]: the cache directory.
+     max_bytes [int]: maximum total size of the stored entries.
+     hits [int]: number of loads that found an entry.
+     misses [int]: number of loads that did not find an entry.
+
+    >>> import shutil
+    >>> cache = DiskCache(tempfile.mkdtemp(), 1 << 20)
+    >>> cache.save({"latex": "x^{2}"}, "function", "x**2", "x")
+    >>> cache.load("function", "x**2", "x")["latex"]
+    'x^{2}'
+    >>> cache.load("function", "x**3", "x") is None
+    True
+    >>> cache.clear()
+    >>> cache.load("function", "x**2", "x") is None
+    True
+    >>> shutil.rmtree(cache.directory)
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        """
+        The initializer.
+
+        Parameters:
+         directory: the cache directory, which is created if needed.
+         max_bytes: maximum total size of the stored entries.
+        """
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: list) -> str:
+        """
+        Get the file name of an entry.
+        """
+        digest = hashlib.sha256(
+            json.dumps(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + ".json")
+
+    def _full_key(self, parts: tuple) -> list:
+        """
+        Get the key of an entry from the parts given by the caller.
+        """
+        return [FORMAT_VERSION, sympy.__version__] + [str(p) for p in parts]
+
+    def load(self, *key_parts: Any) -> Union[Dict[str, Any], None]:
+        """
+        Load an entry.
+
+        Parameters:
+         key_parts: the parts of the key, which are converted to strings.
+
+        Returns:
+         The stored entry or None if there is no valid entry.
+        """
+        key = self._full_key(key_parts)
+        path = self._path(key)
+        try:
+            if not (self._is_private(self.directory)
+                    and self._is_private(path)):
+                self.misses += 1
+                return None
+            with open(path, "r") as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError):
+            self._remove(path)
+            self.misses += 1
+            return None
+        if not isinstance(stored, dict) or stored.get("key") != key:
+            # Either corrupt or a hash collision.
+            self._remove(path)
+            self.misses += 1
+            return None
+        try:
+            # Record the access for the eviction policy.
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return stored["entry"]
+
+    def save(self, entry: Dict[str, Any], *key_parts: Any) -> None:
+        """
+        Store an entry. The file is written to a temporary
+        location first and then moved into place, so readers never
+        see a partially written entry.
+
+        Parameters:
+         entry: a JSON serializable dictionary.
+         key_parts: the parts of the key, which are converted to strings.
+        """
+        key = self._full_key(key_parts)
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"key": key, "entry": entry}, f)
+            os.replace(tmp_path, self._path(key))
+        except (OSError, TypeError, ValueError) as e:
+            print(e)
+            return
+        self._evict()
+
+    def clear(self) -> None:
+        """
+        Remove every entry.
+        """
+        for path, _, _ in self._entries():
+            self._remove(path)
+
+    def _entries(self) -> list:
+        """
+        Get the path, size and access time of every stored entry.
+        """
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for dir_entry in it:
+                    if dir_entry.name.endswith(".json"):
+                        stat = dir_entry.stat()
+                        entries.append((dir_entry.path, stat.st_size,
+                                        stat.st_mtime))
+        except OSError:
+            pass
+        return entries
+
+    def _evict(self) -> None:
+        """
+        Delete the least recently used entries until the
+        cache fits in max_bytes.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        entries.sort(key=lambda e: e[2])
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _is_private(path: str) -> bool:
+        """
+        Check that a file or directory is owned by the current user
+        and can't be written by anyone else. Raises OSError if it
+        can't be accessed. This is always true where files have
+        no owners.
+        """
+        if not hasattr(os, "getuid"):
+            return True
+        stat = os.stat(path)
+        return stat.st_uid == os.getuid() and not stat.st_mode & 0o022
+
+    def _remove(self, path: str) -> None:
+        """
+        Remove a file, ignoring files that are already gone.
+        """
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
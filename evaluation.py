@@ -0,0 +1,404 @@
+# Copyright (C) 2020 Mark (marl0ny)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Evaluation of sampled functions over large arrays.
+"""
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Sequence, Tuple, Union
+
+
+def bucket_size(n: int) -> int:
+    """
+    Round a number of points up to the next power of two, so that
+    arrays sized by it are only reallocated when the number of points
+    changes by a large factor.
+
+    >>> bucket_size(1000), bucket_size(1024), bucket_size(1025)
+    (1024, 1024, 2048)
+    """
+    return 1 << max(int(n) - 1, 0).bit_length()
+
+
+class ChunkedEvaluator:
+    """
+    Evaluate a function over an array by splitting the array into
+    chunks that fit in the cache and evaluating these on a pool of
+    threads. Numpy ufuncs release the GIL, so the chunks are evaluated
+    in parallel. Arrays smaller than the threshold are evaluated
+    directly on the calling thread.
+
+    The function must accept an out keyword argument,
+    as FunctionRtoR does. A function with an is_pointwise method
+    that returns False, whose value at a point depends on the
+    neighbouring points, is always evaluated over the whole array.
+    A function with a prepare method has it called with the first
+    chunk on the calling thread, before the chunks are evaluated.
+
+    Attributes:
+     workers [int]: the number of threads.
+     threshold [int]: the smallest array that is split into chunks.
+     chunk_size [int]: the number of points in each chunk.
+
+    >>> evaluator = ChunkedEvaluator(workers=4, threshold=10, chunk_size=3)
+    >>> def f(x, a, out=None):
+    ...     return np.multiply(x, a, out=out)
+    >>> evaluator.evaluate(f, np.arange(11.0), (2.0,))
+    array([ 0.,  2.,  4.,  6.,  8., 10., 12., 14., 16., 18., 20.])
+    >>> evaluator.shutdown()
+    """
+
+    def __init__(self, workers: int = None, threshold: int = 1 << 17,
+                 chunk_size: int = 1 << 15) -> None:
+        """
+        The initializer.
+
+        Parameters:
+         workers: the number of threads, which defaults to
+         the number of processors.
+         threshold: the smallest array that is split into chunks.
+         chunk_size: the number of points in each chunk.
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self._pool = None
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        """
+        Get the thread pool, which is created when it is first needed
+        and then reused.
+        """
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def evaluate(self, function: Callable, x: np.ndarray,
+                 params: Sequence[float],
+                 out: Union[np.ndarray, None] = None) -> np.ndarray:
+        """
+        Evaluate a function over an array.
+
+        Parameters:
+         function: the function, called as function(x, *params, out=out).
+         x: the input array.
+         params: the other arguments of the function.
+         out: optional array for the output.
+
+        Returns:
+         The output array.
+        """
+        if out is None:
+            out = np.empty(x.shape)
+        n = len(x)
+        is_pointwise = getattr(function, "is_pointwise", None)
+        if (n < self.threshold or self.workers <= 1
+                or (is_pointwise is not None and not is_pointwise())):
+            function(x, *params, out=out)
+            return out
+        c = self.chunk_size
+        prepare = getattr(function, "prepare", None)
+        if prepare is not None:
+            prepare(x[: c], params)
+        pool = self._get_pool()
+        futures = [pool.submit(function, x[i: i + c], *params,
+                               out=out[i: i + c])
+                   for i in range(0, n, c)]
+        for future in futures:
+            # Raises any exception from the function.
+            future.result()
+        return out
+
+    def shutdown(self) -> None:
+        """
+        Stop the threads.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class DoubleBuffer:
+    """
+    A front array, which holds the result that is in use, and a back
+    array that the next result is evaluated into. Once it is ready
+    the back array is published as the new front, and the old front
+    becomes the back, so the same two arrays are used again and
+    again. When another thread is evaluating, a result can be in use,
+    finished and waiting, and being evaluated all at once, so a few
+    spare back arrays are kept. Arrays are allocated with their
+    first dimension rounded up to a bucket_size and handed out as
+    views of the right length, so a new array is only allocated when
+    the size moves to another bucket or no spare array is left.
+
+    Attributes:
+     front [np.ndarray]: the array in use, or None.
+     max_spares [int]: the most back arrays that are kept.
+     allocations [int]: the number of arrays that were allocated.
+
+    >>> buffers = DoubleBuffer()
+    >>> for i in range(4):
+    ...     y = buffers.publish(np.multiply(np.arange(3.0), i,
+    ...                                     out=buffers.acquire((3,))))
+    >>> y, buffers.allocations
+    (array([0., 3., 6.]), 2)
+    >>> y is buffers.front
+    True
+    >>> buffers.publish(buffers.acquire((4,))).shape, buffers.allocations
+    ((4,), 2)
+    """
+
+    def __init__(self, max_spares: int = 2) -> None:
+        """
+        The initializer.
+
+        Parameters:
+         max_spares: the most back arrays that are kept.
+        """
+        self.front = None
+        self.max_spares = max_spares
+        self.allocations = 0
+        self._spares = []
+        self._lock = threading.Lock()
+
+    def acquire(self, shape: tuple) -> np.ndarray:
+        """
+        Take a back array, to write the next result into.
+
+        Parameters:
+         shape: the shape of the result.
+
+        Returns:
+         The array, which must then be either published or released.
+        """
+        size = (bucket_size(shape[0]),) + tuple(shape[1:])
+        with self._lock:
+            while self._spares != []:
+                back = self._spares.pop()
+                if back.shape == size:
+                    return back[: shape[0]]
+            self.allocations += 1
+        return np.empty(size)[: shape[0]]
+
+    def publish(self, array: np.ndarray) -> np.ndarray:
+        """
+        Make an array taken with acquire the front array.
+        The previous front array must no longer be used.
+
+        Parameters:
+         array: the array.
+
+        Returns:
+         The array.
+        """
+        with self._lock:
+            if self.front is not None and self.front is not array:
+                self._keep(self.front)
+            self.front = array
+        return array
+
+    def release(self, array: np.ndarray) -> None:
+        """
+        Give back an array taken with acquire that wasn't published.
+
+        Parameters:
+         array: the array.
+        """
+        with self._lock:
+            if array is not self.front:
+                self._keep(array)
+
+    def _keep(self, array: np.ndarray) -> None:
+        """
+        Keep the whole of an array as a spare, if there is room.
+        The lock must be held.
+        """
+        if len(self._spares) < self.max_spares:
+            self._spares.append(array.base)
+
+
+class EvaluationScheduler:
+    """
+    Run evaluations on a worker thread, one at a time, where only the
+    newest request matters. A request that is submitted while another
+    is waiting replaces it, and the result of a request is dropped
+    once a newer result has been taken or the requests are cancelled.
+    Results are collected by polling, for example once per frame,
+    so that they are only applied on the thread that polls.
+    Dropped results can be handed to a discard function, so that
+    their arrays can be reused.
+
+    Attributes:
+     dropped [int]: the number of requests that were replaced before
+                    they started, or whose results were dropped.
+     completed [int]: the number of results that were taken.
+
+    >>> scheduler = EvaluationScheduler()
+    >>> scheduler.submit(lambda: 2.0*np.arange(3.0), "a")
+    >>> scheduler.wait()
+    >>> scheduler.poll()
+    ('a', array([0., 2., 4.]))
+    >>> scheduler.poll() is None
+    True
+    >>> scheduler.close()
+    """
+
+    def __init__(self, discard: Callable[[Any], None] = None) -> None:
+        """
+        The initializer, which starts the worker thread.
+
+        Parameters:
+         discard: called with each result that is dropped, other
+         than exceptions. It may be called from the worker thread.
+        """
+        self.discard = discard
+        self.dropped = 0
+        self.completed = 0
+        # Each request and result has a number, which increases
+        # with each request.
+        self._number = 0
+        self._pending = None
+        self._running = None
+        self._result = None
+        self._oldest_wanted = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, evaluate: Callable[[], Any], key: Any) -> None:
+        """
+        Request an evaluation, replacing the one that is waiting to
+        start if there is one.
+
+        Parameters:
+         evaluate: does the evaluation, with no arguments.
+         key: returned with the result, to identify it.
+        """
+        with self._condition:
+            if self._pending is not None:
+                self.dropped += 1
+            self._number += 1
+            self._pending = (self._number, evaluate, key)
+            self._condition.notify_all()
+
+    def poll(self) -> Union[Tuple[Any, Any], None]:
+        """
+        Take the newest result that hasn't been taken yet.
+
+        Returns:
+         The key and the result of the request, or None. If
+         the evaluation raised an exception, that is the result.
+        """
+        with self._condition:
+            if self._result is None:
+                return None
+            number, key, result = self._result
+            self._result = None
+            self._oldest_wanted = number + 1
+            self.completed += 1
+            return key, result
+
+    def queue_depth(self) -> int:
+        """
+        Get the number of requests that are running or waiting,
+        plus one if there is a result that hasn't been taken.
+        """
+        with self._condition:
+            return sum(item is not None for item in
+                       (self._pending, self._running, self._result))
+
+    def cancel(self) -> None:
+        """
+        Drop the waiting request and the results of any
+        request made so far.
+        """
+        with self._condition:
+            # A running request is counted once it finishes.
+            self.dropped += sum(item is not None for item in
+                                (self._pending, self._result))
+            dropped = self._result
+            self._pending = None
+            self._result = None
+            self._oldest_wanted = self._number + 1
+        if dropped is not None:
+            self._discard(dropped[2])
+
+    def wait(self) -> None:
+        """
+        Block until no request is running or waiting.
+        """
+        with self._condition:
+            while self._pending is not None or self._running is not None:
+                self._condition.wait()
+
+    def close(self) -> None:
+        """
+        Stop the worker thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._pending = None
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self) -> None:
+        """
+        The worker thread.
+        """
+        while True:
+            with self._condition:
+                self._running = None
+                self._condition.notify_all()
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                number, evaluate, key = self._pending
+                self._pending = None
+                self._running = number
+            try:
+                with np.errstate(all="ignore"):
+                    result = evaluate()
+            except Exception as e:
+                result = e
+            with self._condition:
+                dropped = None
+                if number < self._oldest_wanted:
+                    dropped = (number, key, result)
+                else:
+                    dropped = self._result
+                    self._result = (number, key, result)
+                if dropped is not None:
+                    self.dropped += 1
+            if dropped is not None:
+                self._discard(dropped[2])
+
+    def _discard(self, result: Any) -> None:
+        """
+        Hand a dropped result to the discard function.
+        """
+        if self.discard is not None and not isinstance(result, Exception):
+            self.discard(result)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -16,11 +16,23 @@
 """
 functions.py
 """
+import inspect
+import threading
 import numpy as np
-from sympy import lambdify, abc, latex, diff, integrate
+from time import perf_counter
+from collections import OrderedDict
+from functools import lru_cache
+from sympy import (lambdify, abc, latex, diff, integrate, srepr, Symbol,
+                   Expr, Integral)
 from sympy.parsing.sympy_parser import parse_expr
 from sympy.core import basic
-from typing import Dict, List, Union, Callable
+from typing import (Dict, List, Union, Callable, NamedTuple, Tuple,
+                    FrozenSet, Sequence)
+from disk_cache import DiskCache
+from primitives import registry, register_primitive, rect
+from backends import BufferedEvaluator, NumexprEvaluator
+from symbolic_jobs import SymbolicJob
+import config
 
 
 class VariableNotFoundError(Exception):
@@ -45,27 +57,6 @@ def zero(x: Union[np.ndarray, float],
     """
     return 0.0
 
-def rect(x: 
-         Union[
-         np.ndarray, float]) -> Union[np.ndarray, float]:
-    """
-    Rectangle function. Defined as
-     rect(x) = 1 if x^2 <= 1 else 0
-
-    Parameters:
-     x: input values.
-
-    Returns
-     rect(x)
-    """
-    if isinstance(x, np.ndarray):
-        y = [(1.0 if x[i]**2 <= 1.0 else 0.0) 
-            for i in range(len(x))]
-        y = np.array(y)
-    elif isinstance(x, float):
-        y = 1.0 if x**2 <= 1.0 else 0.0
-    return y
-
 
 def is_defined_at_values(f: Callable, 
                          *args: float, **kw: float) -> bool:
@@ -151,6 +142,350 @@ def multiplies_var(main_var: basic.Basic, arb_var: basic.Basic,
                 (arg is not main_var)])
 
 
+@lru_cache(maxsize=4096)
+def multiplied_symbols(main_var: basic.Basic,
+                       expr: basic.Basic) -> FrozenSet[basic.Basic]:
+    """
+    Find every symbol that multiplies a sub expression containing
+    the main variable, in the sense of multiplies_var.
+    This walks the expression tree once for all symbols
+    instead of once for each symbol, and the result for each
+    sub expression is memoized.
+
+    Parameters:
+     main_var: the main variable
+     expr: an algebraic expression
+
+    Returns:
+     The set of symbols s for which multiplies_var(main_var, s, expr)
+     is True.
+
+    >>> expr = parse_expr("w*a**pi*sin(k**10*tan(y*x)*z) + d + e**10*tan(f)")
+    >>> sorted(str(s) for s in multiplied_symbols(abc.x, expr))
+    ['a', 'k', 'w', 'y', 'z']
+    >>> expr = parse_expr("a*sin(2*pi*k*x)*exp(-((x-mu)/sigma)**2/2)")
+    >>> all((s in multiplied_symbols(abc.x, expr)) ==
+    ...     multiplies_var(abc.x, s, expr) for s in expr.free_symbols)
+    True
+    """
+    symbols = set()
+    arg_list = [arg for arg in expr.args if arg.has(main_var)]
+    for arg1 in arg_list:
+        if not arg1.is_Atom and not isinstance(arg1, Expr):
+            # Such as the conditions of a Piecewise.
+            continue
+        for arg2 in expr.args:
+            if arg2.is_Symbol:
+                candidates = {arg2}
+            elif arg2.is_Pow:
+                candidates = arg2.atoms(Symbol)
+            else:
+                continue
+            if not candidates <= symbols and expr.has(arg1*arg2):
+                symbols |= candidates
+    for arg in arg_list:
+        if arg is not main_var:
+            symbols |= multiplied_symbols(main_var, arg)
+    return frozenset(symbols)
+
+
+class CompiledFunction(NamedTuple):
+    """
+    A compiled sympy expression, as stored in the function cache.
+
+    Attributes:
+     lambda_func [Callable]: the compiled function.
+     latex_repr [str]: the expression as a LaTeX string.
+     symbols [list]: the main variable followed by the parameters,
+                     in the order expected by lambda_func.
+     source [str]: the Python source code of lambda_func.
+    """
+    lambda_func: Callable
+    latex_repr: str
+    symbols: List[basic.Basic]
+    source: str
+
+
+class FunctionCache:
+    """
+    A bounded, least recently used cache of compiled functions.
+
+    Attributes:
+     max_size [int]: maximum number of entries kept in the cache.
+     hits [int]: number of lookups that found an entry.
+     misses [int]: number of lookups that did not find an entry.
+
+    >>> cache = FunctionCache(2)
+    >>> cache.put("a", 1)
+    >>> cache.put("b", 2)
+    >>> cache.get("a")
+    1
+    >>> cache.put("c", 3)
+    >>> "b" in cache
+    False
+    >>> cache.get("b") is None
+    True
+    >>> cache.info()
+    {'hits': 1, 'misses': 1, 'size': 2, 'max_size': 2}
+    """
+
+    def __init__(self, max_size: int = 64) -> None:
+        """
+        The initializer.
+
+        Parameters:
+         max_size: maximum number of entries kept in the cache.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        """
+        Number of entries in the cache.
+        """
+        return len(self._entries)
+
+    def __contains__(self, key: tuple) -> bool:
+        """
+        Check whether there is an entry for key, without
+        counting it as a lookup.
+        """
+        return key in self._entries
+
+    def get(self, key: tuple) -> Union[CompiledFunction, None]:
+        """
+        Look up an entry, marking it as the most recently used.
+
+        Parameters:
+         key: the cache key.
+
+        Returns:
+         The entry, or None if it is not in the cache.
+        """
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key: tuple, entry: CompiledFunction) -> None:
+        """
+        Add an entry, evicting the least recently used entries
+        if the cache is full.
+
+        Parameters:
+         key: the cache key.
+         entry: the entry to store.
+        """
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def resize(self, max_size: int) -> None:
+        """
+        Change the maximum number of entries kept in the cache.
+
+        Parameters:
+         max_size: the new maximum size.
+        """
+        self.max_size = max_size
+        self._evict()
+
+    def clear(self) -> None:
+        """
+        Remove every entry and reset the counters.
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self) -> Dict[str, int]:
+        """
+        Get the hit and miss counters as well as the size of the cache.
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._entries), "max_size": self.max_size}
+
+    def _evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache fits.
+        """
+        while len(self._entries) > max(self.max_size, 0):
+            self._entries.popitem(last=False)
+
+
+register_primitive(zero, "zeros")
+# Dictionary of modules and user defined functions.
+# Used for lambdify from sympy to parse input. Earlier entries take
+# precedence, so the registry comes first to keep numpy functions
+# such as numpy.square from shadowing the primitives.
+module_list = [registry, "numpy"]
+_lambda_namespace = None
+# Ways of evaluating a FunctionRtoR over arrays.
+backends = ("lambdify", "cse", "numexpr", "auto")
+# The backend chosen by timing for each function under the auto
+# backend, keyed by the source code of the function.
+backend_choices: Dict[str, str] = {}
+_backend_choices_lock = threading.Lock()
+
+# Number of points used to integrate numerically from 0 to the start
+# of the sampling points, and the relative step size used to
+# differentiate numerically at a single point.
+numeric_points = 1024
+numeric_step = 1e-5
+# Estimate of how many arrays the size of the output are alive at once
+# while evaluating a function, used to split up parameter sweeps.
+sweep_temporaries = 4
+
+if "Sweep memory budget" in config.config:
+    sweep_memory_budget = config.config["Sweep memory budget"]
+else:
+    sweep_memory_budget = 1 << 26
+
+if "Evaluation backend" in config.config:
+    default_backend = config.config["Evaluation backend"]
+else:
+    default_backend = "lambdify"
+
+if "Function cache size" in config.config:
+    function_cache = FunctionCache(config.config["Function cache size"])
+else:
+    function_cache = FunctionCache()
+
+
+def cumulative_trapezoid(y: np.ndarray, x: np.ndarray,
+                         initial: float = 0.0) -> np.ndarray:
+    """
+    Integrate sampled values with the trapezoid rule, returning
+    the integral from x[0] up to each point. The integral is NaN at
+    samples that are not finite, and the intervals next to them
+    are left out, so the integral carries on after them.
+
+    Parameters:
+     y: the sampled values.
+     x: the sampling points, which need not be evenly spaced.
+     initial: the value of the integral at x[0].
+
+    Returns:
+     The integral at each point.
+
+    >>> cumulative_trapezoid(np.array([1.0, 1.0, 3.0]),
+    ...                      np.array([0.0, 1.0, 2.0]))
+    array([0., 1., 3.])
+    >>> cumulative_trapezoid(np.array([1.0, np.inf, 1.0, 1.0]),
+    ...                      np.array([0.0, 1.0, 2.0, 3.0]))
+    array([ 0., nan,  0.,  1.])
+    """
+    integral = np.empty(y.shape)
+    integral[0] = initial
+    if len(y) > 1:
+        with np.errstate(invalid="ignore"):
+            steps = np.add(y[1:], y[:-1])
+        steps *= np.diff(x)
+        steps *= 0.5
+        steps[~np.isfinite(steps)] = 0.0
+        np.cumsum(steps, out=integral[1:])
+        integral[1:] += initial
+    integral[~np.isfinite(y)] = np.nan
+    return integral
+
+
+def canonical_key(expr: basic.Basic, main_var: basic.Basic,
+                  parameters: List[basic.Basic] = None) -> Tuple[str, ...]:
+    """
+    Get the function cache key of an expression. Expressions
+    returned by parse_expr are already in canonical form, so
+    equivalent inputs such as "x + a" and "a+x" have the same key.
+
+    Parameters:
+     expr: the expression.
+     main_var: the main variable.
+     parameters: the order of the parameters, if it is fixed already.
+
+    >>> key = canonical_key(parse_expr("x + a"), abc.x)
+    >>> key == canonical_key(parse_expr("a+x"), abc.x)
+    True
+    """
+    return _cache_key(srepr(expr), main_var, parameters)
+
+
+def _cache_key(expr_repr: str, main_var: basic.Basic,
+               parameters: List[basic.Basic] = None) -> Tuple[str, ...]:
+    """
+    Same as canonical_key, but for an expression that
+    has already been converted with srepr.
+    """
+    key = (expr_repr, str(main_var))
+    if parameters is not None:
+        key += tuple(str(s) for s in parameters)
+    return key
+
+
+def compile_function(expr: basic.Basic, main_var: basic.Basic,
+                     parameters: List[basic.Basic] = None
+                     ) -> CompiledFunction:
+    """
+    Compile an expression into a numpy function, or get it
+    from the function cache if it was compiled recently.
+
+    Parameters:
+     expr: the expression.
+     main_var: the main variable.
+     parameters: the order of the parameters. If this is not given
+     the parameters are the free symbols of expr apart from main_var,
+     sorted by name.
+
+    Returns:
+     The compiled function.
+    """
+    key = canonical_key(expr, main_var, parameters)
+    entry = function_cache.get(key)
+    if entry is not None:
+        return entry
+    if parameters is None:
+        if main_var not in expr.free_symbols:
+            raise VariableNotFoundError
+        # free_symbols is a set, so its order changes between runs.
+        parameters = sorted(expr.free_symbols - {main_var},
+                            key=lambda s: s.name)
+    symbols = [main_var]
+    symbols.extend(parameters)
+    lambda_func = lambdify(symbols, expr, modules=module_list)
+    try:
+        source = inspect.getsource(lambda_func)
+    except (OSError, TypeError):
+        source = ""
+    entry = CompiledFunction(lambda_func, latex(expr), symbols, source)
+    function_cache.put(key, entry)
+    return entry
+
+
+def lambda_namespace() -> Dict[str, object]:
+    """
+    Get the globals that functions generated by lambdify are run with.
+    """
+    global _lambda_namespace
+    if _lambda_namespace is None:
+        # lambdify builds its namespace from the module list, so take
+        # it from a trivial function.
+        _lambda_namespace = lambdify((), 0, modules=module_list).__globals__
+    return _lambda_namespace
+
+
+if "Disk cache directory" in config.config:
+    if "Disk cache size" in config.config:
+        disk_cache = DiskCache(config.config["Disk cache directory"],
+                               config.config["Disk cache size"])
+    else:
+        disk_cache = DiskCache(config.config["Disk cache directory"],
+                               1 << 24)
+else:
+    disk_cache = None
+
+
 # class FunctionRtoNone:
 #     """
 #     """
@@ -173,83 +508,644 @@ class FunctionRtoR:
     symbols [sympy.Symbol]: All variables used in this function.
     parameters [sympy.Symbol]: All variables used in this function,
                                except for the main variable.
+    backend [str]: How the function is evaluated over arrays.
+    numeric_ops [List[str]]: derivatives and antiderivatives that are
+                             computed numerically over the sampling
+                             points, in the order they are applied
+                             to the symbolic function.
+
+    Every primitive can be used in the function.
+
+    >>> x = np.array([0.5, 1.0, 4.0])
+    >>> for name in ("rect(x)", "step(x)", "triangle(x)", "sawtooth(x)",
+    ...              "square(x)", "sinc(x)", "clamp(x, 0.75, 2)",
+    ...              "between(x, 0.75, 2)", "ramp(x - 2)"):
+    ...     y = FunctionRtoR(name, abc.x)(x)
+    ...     print("%-20s %s" % (name, np.round(y, 4)))
+    rect(x)              [1. 1. 0.]
+    step(x)              [1. 1. 1.]
+    triangle(x)          [0.5 0.  0. ]
+    sawtooth(x)          [-0.8408 -0.6817  0.2732]
+    square(x)            [ 1.  1. -1.]
+    sinc(x)              [ 0.9589  0.8415 -0.1892]
+    clamp(x, 0.75, 2)    [0.75 1.   2.  ]
+    between(x, 0.75, 2)  [0. 1. 0.]
+    ramp(x - 2)          [0. 0. 2.]
     """
 
     # Private Attributes:
-    # _symbolic_func [sympy.basic.Basic]: symbol function
+    # _symbolic_func [sympy.basic.Basic]: symbol function.
     # _lambda_func [sympy.Function]: lamba function
+    # _source [str]: source code of _lambda_func
+    # _symbolic_latex [str]: latex_repr without the numeric operations
+    # _buffered [BufferedEvaluator]: evaluator used by the cse backend,
+    #                                or False if it can't be used
+    # _numexpr [NumexprEvaluator]: evaluator used by the numexpr backend,
+    #                              or False if it can't be used
+    # _default_values [dict]: the default values, once computed
+    # _default_args [tuple]: the default values in the order
+    #                        expected by _lambda_func
 
-    def __init__(self, function_name: str, param: basic.Basic) -> None:
+    def __init__(self, function_name: str, param: basic.Basic,
+                 backend: str = None) -> None:
         """
         The initializer. The parameter must be a
         string representation of a function, and it needs to
-        be a function of x.
-        """
-        # Dictionary of modules and user defined functions.
-        # Used for lambdify from sympy to parse input.
-        module_list = ["numpy", {"rect": rect, "zeros": zero}]
-        self._symbolic_func = parse_expr(function_name)
-        symbol_set = self._symbolic_func.free_symbols
-        symbol_list = list(symbol_set)
-        if param not in symbol_list:
-            raise VariableNotFoundError
-        self.latex_repr = latex(self._symbolic_func)
-        symbol_list.remove(param)
-        self.parameters = symbol_list
-        var_list = [param]
-        var_list.extend(symbol_list)
-        self.symbols = var_list
-        self._lambda_func = lambdify(
-            self.symbols, self._symbolic_func, modules=module_list)
+        be a function of x. The backend is used to evaluate
+        the function over arrays, see set_backend. It defaults to
+        the "Evaluation backend" in the config.
+
+        Compiled functions are shared through the function cache,
+        so switching back to a recently used function is cheap.
+        If the disk cache is enabled, the default values of a
+        function that was used in a previous session, as well as its
+        derivatives and antiderivatives, are loaded from it.
+
+        >>> function_cache.clear()
+        >>> f = FunctionRtoR("a*sin(k*x) + d", abc.x)
+        >>> g = FunctionRtoR("d + a*sin(x*k)", abc.x)
+        >>> function_cache.info()["hits"]
+        1
+        >>> g.parameters == f.parameters
+        True
+        """
+        self.set_backend(default_backend if backend is None else backend)
+        expr = parse_expr(function_name.strip())
+        key_parts = ("function",) + canonical_key(expr, param)
+        if disk_cache is not None:
+            entry = disk_cache.load(*key_parts)
+            if entry is not None and self._set_from_entry(entry):
+                return
+        self._set_expression(expr, param)
+        self._save_entry(key_parts)
 
     def __call__(self, x: Union[np.array, float],
-                 *args: float, **kwargs: float) -> np.array:
+                 *args: float, out: np.ndarray = None,
+                 **kwargs: float) -> np.array:
+        """
+        Call this class as if it were a function. If no parameters
+        are given, the default values are used. If out is given
+        the result is written into it.
+
+        >>> f = FunctionRtoR("a*x + b", abc.x)
+        >>> f(2.0)
+        2.0
+        >>> out = np.zeros(2)
+        >>> f(np.array([1.0, 2.0]), 3.0, 1.0, out=out) is out, out
+        (True, array([4., 7.]))
         """
-        Call this class as if it were a function.
+        if args == () and kwargs == {}:
+            if self._default_args is None:
+                d = self.get_default_values()
+                self._default_args = tuple(d[s] for s in self.parameters)
+            args = self._default_args
+        if self.numeric_ops:
+            y = self._evaluate_numeric(
+                np.asarray(x, dtype=np.float64),
+                lambda t: self._evaluate(t, args, kwargs),
+                len(self.numeric_ops))
+            if out is None:
+                return y if y.ndim > 0 else y[()]
+            out[...] = y
+            return out
+        return self._evaluate(x, args, kwargs, out)
+
+    def _evaluate(self, x: Union[np.array, float], args: tuple,
+                  kwargs: dict, out: np.ndarray = None) -> np.array:
+        """
+        Evaluate the symbolic function with the backend.
+        """
+        if (self.backend != "lambdify" and kwargs == {}
+                and isinstance(x, np.ndarray)):
+            backend = self.backend
+            if backend == "auto":
+                backend = self._choose_backend(x, args)
+            if backend == "cse":
+                evaluator = self._get_buffered_evaluator()
+            elif backend == "numexpr":
+                evaluator = self._get_numexpr_evaluator()
+            else:
+                evaluator = None
+            if evaluator is not None:
+                return evaluator(x, *args, out=out)
+        y = self._lambda_func(x, *args, **kwargs)
+        if out is None:
+            return y
+        out[...] = y
+        return out
+
+    def _evaluate_numeric(self, x: np.ndarray,
+                          base: Callable[[np.ndarray], np.ndarray],
+                          n: int) -> np.ndarray:
         """
-        if args == ():
-            kwargs = self.get_default_values()
-            args = (kwargs[s] for s in kwargs)
-        return self._lambda_func(x, *args, **kwargs)
+        Evaluate the symbolic function followed by the first n
+        numeric operations. Derivatives are second order finite
+        differences over x, and antiderivatives are trapezoid rule
+        integrals from 0, so that they don't depend on where the
+        sampling points start. If the function isn't finite
+        everywhere between 0 and the first point, they are integrals
+        from the first point where it is finite instead.
+
+        Parameters:
+         x: the sampling points, in increasing order.
+         base: evaluates the symbolic function.
+         n: the number of numeric operations to apply.
+
+        Returns:
+         The values at x.
+        """
+        if n == 0:
+            y = np.empty(x.shape)
+            y[...] = base(x)
+            return y
+        if self.numeric_ops[n - 1] == "derivative":
+            if x.size < 3:
+                h = numeric_step*np.maximum(1.0, np.abs(x))
+                y = self._evaluate_numeric(x + h, base, n - 1)
+                y -= self._evaluate_numeric(x - h, base, n - 1)
+                y /= 2.0*h
+                return y
+            return np.gradient(self._evaluate_numeric(x, base, n - 1), x,
+                               edge_order=2)
+        flat_x = x.reshape(-1)
+        s = np.linspace(0.0, flat_x[0], numeric_points)
+        with np.errstate(all="ignore"):
+            y = self._evaluate_numeric(s, base, n - 1)
+        offset = 0.0
+        if np.all(np.isfinite(y)):
+            offset = cumulative_trapezoid(y, s)[-1]
+        y = self._evaluate_numeric(flat_x, base, n - 1)
+        return cumulative_trapezoid(y, flat_x, offset).reshape(x.shape)
+
+    def sweep(self, x: np.ndarray, *param_values: Union[np.ndarray, float],
+              out: np.ndarray = None) -> np.ndarray:
+        """
+        Evaluate the function over x for many values of the parameters
+        at once, broadcasting the parameters against x. The rows are
+        evaluated in chunks so that the temporary arrays stay within
+        sweep_memory_budget bytes, which is set by the
+        "Sweep memory budget" in the config.
+
+        Parameters:
+         x: the sampling points, a 1D array.
+         param_values: one value or 1D array of values for each
+         parameter, in the order of self.parameters. These are
+         broadcast against each other.
+         out: optional array for the output.
+
+        Returns:
+         An array with one row for each set of parameter values.
+
+        >>> f = FunctionRtoR("a*x + b", abc.x)
+        >>> f.sweep(np.array([0.0, 1.0, 2.0]), np.array([1.0, 2.0]), 1.0)
+        array([[1., 2., 3.],
+               [1., 3., 5.]])
+        >>> g = FunctionRtoR("clamp(x, a, 1)", abc.x)
+        >>> g.sweep(np.linspace(-2.0, 2.0, 5), np.array([-1.0, 0.0]))
+        array([[-1., -1.,  0.,  1.,  1.],
+               [ 0.,  0.,  0.,  1.,  1.]])
+        """
+        if len(param_values) != len(self.parameters):
+            raise TypeError("Expected %d parameter values, got %d"
+                            % (len(self.parameters), len(param_values)))
+        x = np.asarray(x, dtype=np.float64)
+        param_values = np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(p, dtype=np.float64))
+              for p in param_values], np.empty(1))[:-1]
+        rows = len(param_values[0]) if param_values else 1
+        if out is None:
+            out = np.empty((rows, len(x)))
+        row_bytes = max(1, sweep_temporaries*x.nbytes)
+        chunk = max(1, sweep_memory_budget//row_bytes)
+        for i in range(0, rows, chunk):
+            params = [p[i: i + chunk] for p in param_values]
+            if self.numeric_ops:
+                # Numeric operations act along x, one curve at a time.
+                for j in range(len(out[i: i + chunk])):
+                    self(x, *[p[j] for p in params], out=out[i + j])
+            else:
+                # Primitives size their output from x, so x is given
+                # the shape of the output rather than broadcast.
+                grid = np.broadcast_to(x, out[i: i + chunk].shape)
+                out[i: i + chunk] = self._lambda_func(
+                    grid, *[p[:, np.newaxis] for p in params])
+        return out
+
+    def is_numeric(self) -> bool:
+        """
+        Check whether any derivatives or antiderivatives
+        are computed numerically.
+        """
+        return len(self.numeric_ops) > 0
+
+    def is_pointwise(self) -> bool:
+        """
+        Check whether the value at each point can be computed on its own.
+        Numeric derivatives and antiderivatives depend on the
+        neighbouring points, so arrays can't be split up to evaluate them.
+        """
+        return not self.numeric_ops
+
+    def apply_numeric(self, operation: str) -> None:
+        """
+        Mutate this function into its derivative or antiderivative,
+        computed numerically over the sampling points each time it is
+        called. This is used when sympy can't do it symbolically,
+        or takes too long.
+
+        Parameters:
+         operation: either "derivative" or "antiderivative".
+
+        >>> f = FunctionRtoR("sin(x)", abc.x)
+        >>> f.apply_numeric("derivative")
+        >>> x = np.linspace(-np.pi, np.pi, 1024)
+        >>> bool(np.amax(np.abs(f(x) - np.cos(x))) < 1e-4)
+        True
+        >>> g = FunctionRtoR("a*cos(k*x)", abc.x)
+        >>> g.apply_numeric("antiderivative")
+        >>> exact = np.sin(2.0*x)
+        >>> bool(np.amax(np.abs(g(x, 2.0, 2.0) - exact)) < 1e-4)
+        True
+        >>> bool(abs(g(1.0, 2.0, 2.0) - np.sin(2.0)) < 1e-4)
+        True
+        >>> g.apply_numeric("derivative")
+        >>> g.numeric_ops
+        []
+
+        Where the function isn't defined between 0 and the sampling
+        points, the antiderivative starts from the first point.
+
+        >>> h = FunctionRtoR("1/x", abc.x)
+        >>> h.apply_numeric("antiderivative")
+        >>> x = np.linspace(1.0, 3.0, 1024)
+        >>> bool(np.amax(np.abs(h(x) - np.log(x))) < 1e-4)
+        True
+        """
+        if operation not in ("derivative", "antiderivative"):
+            raise ValueError("Unknown operation %s" % operation)
+        if (operation == "derivative" and self.numeric_ops
+                and self.numeric_ops[-1] == "antiderivative"):
+            # The derivative of the integral is the original function.
+            self.numeric_ops.pop()
+        else:
+            self.numeric_ops.append(operation)
+        self.latex_repr = self._numeric_latex()
+
+    def _numeric_latex(self) -> str:
+        """
+        Get the LaTeX string of the function, including
+        the numeric operations.
+        """
+        latex_repr = self._symbolic_latex
+        var = latex(self.symbols[0])
+        for operation in self.numeric_ops:
+            if operation == "derivative":
+                latex_repr = r"\frac{d}{d%s}\left(%s\right)" % (var,
+                                                                latex_repr)
+            else:
+                latex_repr = r"\int_{0}^{%s} %s \, d%s" % (var, latex_repr,
+                                                             var)
+        return latex_repr
+
+    def set_backend(self, backend: str) -> None:
+        """
+        Set how the function is evaluated over arrays.
+
+        Parameters:
+         backend: either "lambdify", which calls the function generated
+         by lambdify, or "cse", which evaluates repeated sub expressions
+         only once and does every operation in place on preallocated
+         buffers. Functions that can't be evaluated in place fall back
+         to lambdify. Both give identical results. "numexpr" evaluates
+         the function with numexpr, which works through the array in
+         blocks on several threads, if numexpr is installed. Functions
+         that numexpr doesn't support, like rect, fall back to lambdify.
+         "auto" times each of these the first time the function is
+         evaluated over a large enough array and uses the fastest.
+
+        >>> f = FunctionRtoR("a*sin(x)**2 + sin(x)", abc.x, backend="cse")
+        >>> x = np.linspace(-1.0, 1.0, 5)
+        >>> bool(np.all(f(x, 2.0) == f._lambda_func(x, 2.0)))
+        True
+        >>> g = FunctionRtoR("exp(-x**2)*cos(k*x)", abc.x, backend="numexpr")
+        >>> bool(np.allclose(g(x, 3.0), g._lambda_func(x, 3.0)))
+        True
+        """
+        if backend not in backends:
+            raise ValueError("Unknown backend %s" % backend)
+        self.backend = backend
+
+    def _get_buffered_evaluator(self) -> Union[BufferedEvaluator, None]:
+        """
+        Get the evaluator used by the cse backend, generating it the
+        first time. Returns None if the function can't be evaluated
+        in place.
+        """
+        if self._buffered is None and self._source != "":
+            try:
+                self._buffered = BufferedEvaluator(self._source,
+                                                   lambda_namespace())
+            except NotImplementedError:
+                self._buffered = False
+        return self._buffered if self._buffered else None
+
+    def _get_numexpr_evaluator(self) -> Union[NumexprEvaluator, None]:
+        """
+        Get the evaluator used by the numexpr backend, creating it the
+        first time. Returns None if numexpr isn't installed or
+        doesn't support the function.
+        """
+        if self._numexpr is None:
+            try:
+                self._numexpr = NumexprEvaluator(self._symbolic_func,
+                                                 self.symbols[0],
+                                                 self.parameters)
+            except NotImplementedError:
+                self._numexpr = False
+        return self._numexpr if self._numexpr else None
+
+    def prepare(self, x: np.ndarray, params: Sequence[float]) -> None:
+        """
+        Get ready to evaluate over arrays like x, before they are split
+        up and evaluated on several threads. With the auto backend this
+        chooses the backend, so that it is timed once and without
+        other threads competing for the processor.
+
+        Parameters:
+         x: an array like those the function is about to be
+         evaluated over.
+         params: the parameters.
+        """
+        if self.backend == "auto" and not self.numeric_ops:
+            self._choose_backend(x, tuple(params))
+
+    def _choose_backend(self, x: np.ndarray, args: tuple) -> str:
+        """
+        Get the backend used by the auto backend. The first time
+        a function is evaluated over at least 1000 points, each
+        backend that supports it is timed and the fastest is
+        remembered in backend_choices and in the disk cache. Before
+        that lambdify is used.
+
+        Parameters:
+         x: the array the function is about to be evaluated over.
+         args: the parameters.
+
+        Returns:
+         The name of the backend.
+        """
+        choice = backend_choices.get(self._source)
+        if choice is not None:
+            return choice
+        if x.size < 1000 or self._source == "":
+            return "lambdify"
+        with _backend_choices_lock:
+            # Another thread may have chosen while this one waited.
+            choice = backend_choices.get(self._source)
+            if choice is None and disk_cache is not None:
+                entry = disk_cache.load("backend", self._source)
+                if entry is not None and entry.get("backend") in backends:
+                    choice = entry["backend"]
+            if choice is None:
+                choice = self._time_backends(x, args)
+                if disk_cache is not None:
+                    disk_cache.save({"backend": choice},
+                                    "backend", self._source)
+            backend_choices[self._source] = choice
+        return choice
+
+    def _time_backends(self, x: np.ndarray, args: tuple) -> str:
+        """
+        Time each backend that supports this function over x,
+        and get the fastest.
+        """
+        candidates = {"lambdify": self._lambda_func,
+                      "cse": self._get_buffered_evaluator(),
+                      "numexpr": self._get_numexpr_evaluator()}
+        out = np.empty(x.shape)
+        times = {}
+        with np.errstate(all="ignore"):
+            for name, evaluator in candidates.items():
+                if evaluator is None:
+                    continue
+                best = float("inf")
+                for _ in range(3):
+                    t1 = perf_counter()
+                    if name == "lambdify":
+                        evaluator(x, *args)
+                    else:
+                        evaluator(x, *args, out=out)
+                    best = min(best, perf_counter() - t1)
+                times[name] = best
+        return min(times, key=times.get)
 
     def __str__(self) -> str:
         """
         string representation of the function.
         """
-        return str(self._symbolic_func)
+        return self._name
+
+    @property
+    def _symbolic_func(self) -> basic.Basic:
+        """
+        The symbolic function.
+        """
+        return self._symbolic
 
     def get_function_name(self) -> str:
         """
         Get the name of the function.
         """
-        return str(self._symbolic_func)
+        return self._name
+
+    def get_key(self) -> tuple:
+        """
+        Get a key that identifies what this function computes, for
+        caching its values. Equivalent functions have the same key.
+
+        >>> f = FunctionRtoR("a*x", abc.x)
+        >>> f.get_key() == FunctionRtoR("x*a", abc.x).get_key()
+        True
+        """
+        return (_cache_key(self._srepr, self.symbols[0], self.parameters)
+                + tuple(self.numeric_ops))
+
+    def _set_expression(self, expr: basic.Basic, main_var: basic.Basic,
+                        parameters: List[basic.Basic] = None) -> None:
+        """
+        Set this to a new function given by a sympy expression.
+
+        Parameters:
+         expr: the expression.
+         main_var: the main variable.
+         parameters: the order of the parameters, if these should
+         stay the same as before.
+        """
+        compiled = compile_function(expr, main_var, parameters)
+        self._symbolic = expr
+        self._srepr = srepr(expr)
+        self._name = str(expr)
+        self.latex_repr = compiled.latex_repr
+        self._symbolic_latex = compiled.latex_repr
+        self.numeric_ops = []
+        self.symbols = list(compiled.symbols)
+        self.parameters = self.symbols[1:]
+        self._lambda_func = compiled.lambda_func
+        self._source = compiled.source
+        self._buffered = None
+        self._numexpr = None
+        self._default_values = None
+        self._default_args = None
+
+    def _set_from_entry(self, entry: dict) -> bool:
+        """
+        Set this to a function stored in the disk cache. The stored
+        expression is compiled again, rather than storing code.
+
+        Parameters:
+         entry: the stored entry.
+
+        Returns:
+         Whether the entry could be used.
+        """
+        try:
+            symbols = [Symbol(name) for name in entry["symbols"]]
+            expr = parse_expr(entry["expression"])
+            defaults = {str(s): float(v) for s, v in
+                        entry["defaults"].items()}
+            default_values = {s: defaults[str(s)] for s in symbols[1:]}
+            name = entry["name"]
+        except Exception as e:
+            print(e)
+            return False
+        self._set_expression(expr, symbols[0], symbols[1:])
+        self._default_values = default_values
+        self._name = name
+        return True
+
+    def _save_entry(self, key_parts: tuple) -> None:
+        """
+        Store this function in the disk cache, if it is enabled.
+
+        Parameters:
+         key_parts: the key of the entry.
+        """
+        if disk_cache is None:
+            return
+        defaults = self.get_default_values()
+        disk_cache.save({"expression": self._srepr,
+                         "name": self._name,
+                         "symbols": [str(s) for s in self.symbols],
+                         "defaults": {str(s): defaults[s] for s in defaults}},
+                        *key_parts)
 
-    def _reset_samesymbols(self) -> None:
+    def _reset_samesymbols(self, expr: basic.Basic) -> None:
         """
         Set to a new function, assuming the same variables.
         """
-        self.latex_repr = latex(self._symbolic_func)
-        self._lambda_func = lambdify(
-            self.symbols, self._symbolic_func)
+        self._set_expression(expr, self.symbols[0], self.parameters)
 
     def get_default_values(self) -> Dict[basic.Basic, float]:
         """
         Get a dict of the suggested default values for each parameter
-        used in this function.
+        used in this function. These are only computed once
+        for each expression.
         """
-        return {s:
-                float(multiplies_var(self.symbols[0], s, self._symbolic_func))
-                for s in self.parameters}
+        if self._default_values is None:
+            symbols = multiplied_symbols(self.symbols[0],
+                                         self._symbolic_func)
+            self._default_values = {s: float(s in symbols)
+                                    for s in self.parameters}
+        return dict(self._default_values)
 
     def get_enumerated_default_values(self) -> dict:
         """
         Get an enumerated dict of the suggested default values for each parameter
         used in this function.
         """
-        return {i: [s, 
-                float(multiplies_var(
-                      self.symbols[0], s, self._symbolic_func))]
-                for i, s in enumerate(self.parameters)}
+        d = self.get_default_values()
+        return {i: [s, d[s]] for i, s in enumerate(self.parameters)}
+
+    def _transform_key(self, operation: str) -> tuple:
+        """
+        Get the disk cache key of a transformation of this function.
+        """
+        return (operation, self._srepr, *[str(s) for s in self.symbols])
+
+    def load_transform(self, operation: str) -> bool:
+        """
+        Mutate this function using the result of a transformation,
+        such as "derivative", if it is in the disk cache.
+
+        Parameters:
+         operation: the name of the transformation.
+
+        Returns:
+         Whether the result was found.
+        """
+        if disk_cache is None or self.numeric_ops:
+            return False
+        entry = disk_cache.load(*self._transform_key(operation))
+        return entry is not None and self._set_from_entry(entry)
+
+    def apply_transform(self, operation: str,
+                        expr: Union[basic.Basic, str]) -> None:
+        """
+        Mutate this function into the result of a transformation that
+        was computed elsewhere, for example by a SymbolicJob,
+        and store it in the disk cache. If sympy couldn't evaluate
+        an integral, it is computed numerically instead.
+
+        Parameters:
+         operation: the name of the transformation.
+         expr: the new expression or its srepr.
+
+        >>> f = FunctionRtoR("a*x", abc.x)
+        >>> f.apply_transform("derivative", "Symbol('a')")
+        >>> str(f), f.parameters
+        ('a', [a])
+        """
+        key_parts = self._transform_key(operation)
+        if isinstance(expr, str):
+            expr = parse_expr(expr)
+        if self.numeric_ops or expr.has(Integral):
+            self.apply_numeric(operation)
+            return
+        self._reset_samesymbols(expr)
+        self._save_entry(key_parts)
+
+    def transform_job(self, operation: str,
+                      timeout: float = None) -> SymbolicJob:
+        """
+        Get a job that computes a transformation of this function
+        in another process. The job must be started, and its
+        result given to apply_transform once it is done.
+
+        Parameters:
+         operation: either "derivative" or "antiderivative".
+         timeout: seconds after which the job is cancelled.
+
+        Returns:
+         The job.
+        """
+        return SymbolicJob(operation, self._srepr, str(self.symbols[0]),
+                           timeout)
+
+    def _transform(self, operation: str,
+                   transform: Callable[[basic.Basic], basic.Basic]) -> None:
+        """
+        Mutate this function using a symbolic transformation, such as
+        differentiation, reusing the result from the disk cache
+        if it was computed before.
+
+        Parameters:
+         operation: the name of the transformation.
+         transform: maps the current expression to the new one.
+        """
+        if self.numeric_ops:
+            self.apply_numeric(operation)
+        elif not self.load_transform(operation):
+            self.apply_transform(operation, transform(self._symbolic_func))
 
     def derivative(self) -> None:
         """
@@ -260,9 +1156,8 @@ class FunctionRtoR:
         >>> str(f)
         'a*k*cos(k*x)'
         """
-        self._symbolic_func = diff(self._symbolic_func,
-                                   self.symbols[0])
-        self._reset_samesymbols()
+        self._transform("derivative",
+                        lambda expr: diff(expr, self.symbols[0]))
 
     def antiderivative(self) -> None:
         """
@@ -273,14 +1168,15 @@ class FunctionRtoR:
         >>> str(f)
         'a*Piecewise((-cos(k*x)/k, Ne(k, 0)), (0, True)) + d*x'
         """
-        self._symbolic_func = integrate(self._symbolic_func,
-                                        self.symbols[0])
-        self._reset_samesymbols()
+        self._transform("antiderivative",
+                        lambda expr: integrate(expr, self.symbols[0]))
 
 
 if __name__ == "__main__":
     import doctest
     from time import perf_counter
+    # Keep the doctests from reading or writing the disk cache.
+    disk_cache = None
     t1 = perf_counter()
     doctest.testmod()
     t2 = perf_counter()
@@ -13,12 +13,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import atexit
 import numpy as np
 import matplotlib.pyplot as plt
 from animator import Animator
 from functions import FunctionRtoR, is_defined_at_values, VariableNotFoundError
+from evaluation import ChunkedEvaluator, DoubleBuffer, EvaluationScheduler
+from prefetch import SliderPrefetcher
+from sampling import AdaptiveSampler, SampleBuffer, TileCache
+from decimation import m4_decimate
 from sympy import abc
-from typing import Tuple, List
+from typing import Tuple, List, Sequence
 import config
 
 
@@ -65,6 +70,17 @@ class PlottyAnimator(Animator):
          between each animation frame.
         """
         Animator.__init__(self, dpi, figsize, interval)
+        if "Pause when idle" in config.config:
+            self.pause_when_idle = config.config["Pause when idle"]
+        self._evaluator = ChunkedEvaluator()
+        if "Evaluation threads" in config.config:
+            self._evaluator.workers = config.config["Evaluation threads"]
+        if "Threaded evaluation threshold" in config.config:
+            self._evaluator.threshold = config.config[
+                "Threaded evaluation threshold"]
+        if "Evaluation chunk size" in config.config:
+            self._evaluator.chunk_size = config.config[
+                "Evaluation chunk size"]
         ax = self.figure.add_subplot(1, 1, 1)
         # self.t = np.linspace(-np.pi, np.pi, 256)
         if "Number of points" in config.config:
@@ -72,6 +88,25 @@ class PlottyAnimator(Animator):
             self.t = np.linspace(-np.pi, np.pi, n)
         else:
             self.t = np.linspace(-np.pi, np.pi, 1024)
+        self.number_of_points = len(self.t)
+        # The values of the function and the evenly spaced sampling
+        # points are evaluated into the back arrays of these and then
+        # swapped in, so the same arrays are used again.
+        self._y_buffers = DoubleBuffer()
+        self._t_buffers = DoubleBuffer()
+        self._ramp = None
+        # Points across the plot per pixel of its width. If this
+        # isn't set the number of points is fixed.
+        self.points_per_pixel = config.config.get("Points per pixel", None)
+        # Coarse samples have this many times fewer points, and are
+        # used while the view is being zoomed.
+        self.coarse_factor = 4
+        self._sampler = None
+        if config.config.get("Adaptive sampling", False):
+            self._sampler = AdaptiveSampler()
+            if "Maximum number of points" in config.config:
+                self._sampler.max_points = config.config[
+                    "Maximum number of points"]
         ax.grid()
         if "function" in config.config:
             f = config.config["function"]
@@ -81,8 +116,11 @@ class PlottyAnimator(Animator):
             self.function = FunctionRtoR("sin(x)", abc.x)
             ax.set_title("f(x) = sin(x)")
         default_values = self.function.get_default_values()
-        self.params = (default_values[key] for key in default_values)
-        self.y = self.function(self.t, *self.params)
+        self.params = tuple(default_values[key] for key in default_values)
+        self._set_y(self._evaluate_into_back(self.function, self.params))
+        # The parameters that self.y was evaluated with, which lag
+        # behind self.params while the scheduler is evaluating.
+        self._y_params = self.params
         ax.set_xlim(np.amin(self.t), np.amax(self.t))
         ax.set_xlabel("x")
         if "Plot Colour" in config.config:
@@ -91,6 +129,52 @@ class PlottyAnimator(Animator):
         else:
             line, = ax.plot(self.t, self.y)
         self.line = line
+        self._symbolic_job = None
+        self._symbolic_job_function = None
+        # Jobs that have finished but whose worker
+        # processes haven't exited yet.
+        self._exiting_jobs = []
+        if "Symbolic timeout" in config.config:
+            self.symbolic_timeout = config.config["Symbolic timeout"]
+        else:
+            self.symbolic_timeout = 30.0
+        self._prefetcher = None
+        if config.config.get("Slider prefetch", False):
+            if "Slider prefetch memory" in config.config:
+                self._prefetcher = SliderPrefetcher(
+                    config.config["Slider prefetch memory"])
+            else:
+                self._prefetcher = SliderPrefetcher(1 << 26)
+        # Whether self.y is shared with the prefetch cache.
+        self._y_shared = False
+        # Evaluates for new parameters on another thread.
+        self._scheduler = None
+        if config.config.get("Asynchronous evaluation", False):
+            self._scheduler = EvaluationScheduler(
+                discard=self._y_buffers.release)
+        self._samples = SampleBuffer()
+        # What the line was last set to, to avoid decimating
+        # the same samples again.
+        self._line_key = None
+        if "Tile cache memory" in config.config:
+            tile_cache_memory = config.config["Tile cache memory"]
+        else:
+            tile_cache_memory = 1 << 26
+        self._tiles = None
+        if tile_cache_memory > 0:
+            self._tiles = TileCache(tile_cache_memory)
+        # The size of the view when it was last sampled, in
+        # plot coordinates and in pixels, and whether the
+        # samples were coarse.
+        self._view_size = None
+        self._coarse = False
+        if config.config.get("Performance overlay", False):
+            self.show_stats()
+        if config.config.get("Frame stats file", ""):
+            atexit.register(self.stats.dump,
+                            config.config["Frame stats file"])
+        self.update_number_of_points()
+        self.update_line()
 
     def update(self, delta_t: float) -> None:
         """
@@ -99,7 +183,100 @@ class PlottyAnimator(Animator):
         Parameters:
          delta_t: time interval passed between each frame.
         """
-        self.line.set_ydata(self.y)
+        self.apply_evaluation_result()
+        self.update_line()
+
+    def apply_evaluation_result(self) -> None:
+        """
+        Use the newest result from the evaluation scheduler, if it
+        was evaluated at the current sampling points, and keep
+        drawing frames until the scheduler has nothing left to do.
+        """
+        if self._scheduler is None:
+            return
+        result = self._scheduler.poll()
+        if result is not None:
+            (t, params), y = result
+            if isinstance(y, Exception):
+                print(y)
+            elif t is self.t:
+                self._set_y(y)
+                self._y_params = params
+            else:
+                self._y_buffers.release(y)
+        depth = self._scheduler.queue_depth()
+        self.stats.set_counter("evaluation queue", depth)
+        self.stats.set_counter("dropped evaluations",
+                               self._scheduler.dropped)
+        if depth > 0:
+            self.mark_dirty()
+
+    def update_line(self) -> None:
+        """
+        Draw the samples, reduced to at most four points per
+        pixel column so that the cost of drawing depends on the
+        width of the plot rather than on the number of samples.
+        self.t and self.y keep all of the samples.
+        """
+        ax = self.figure.get_axes()[0]
+        xlim = ax.get_xlim()
+        width = max(int(np.ceil(ax.bbox.width)), 1)
+        key = (self.t, self.y, xlim, width)
+        if self._line_key is not None and all(
+                a is b if isinstance(a, np.ndarray) else a == b
+                for a, b in zip(key, self._line_key)):
+            return
+        self._line_key = key
+        with self.stats.measure("decimation"):
+            x, y = m4_decimate(self.t, self.y, xlim, width)
+        self.line.set_data(x, y)
+
+    def evaluate(self, function: FunctionRtoR,
+                 params: Tuple[float], t: np.ndarray = None,
+                 out: np.ndarray = None) -> np.ndarray:
+        """
+        Evaluate a function over the sampling points self.t.
+        Large arrays are evaluated on several threads.
+
+        Parameters:
+         function: the function.
+         params: the parameters of the function.
+         t: other points to evaluate at instead of self.t.
+         out: optional array for the output.
+
+        Returns:
+         The values of the function.
+        """
+        if t is None:
+            t = self.t
+        with self.stats.measure("evaluation"):
+            return self._evaluator.evaluate(function, t, params, out)
+
+    def _evaluate_into_back(self, function: FunctionRtoR,
+                            params: Tuple[float],
+                            t: np.ndarray = None) -> np.ndarray:
+        """
+        Evaluate a function over the sampling points self.t into
+        the back array for self.y, which _set_y then swaps in.
+        This can be called from another thread if t is given.
+        """
+        if t is None:
+            t = self.t
+        y = self._y_buffers.acquire(t.shape)
+        try:
+            return self._evaluator.evaluate(function, t, params, y)
+        except Exception:
+            self._y_buffers.release(y)
+            raise
+
+    def _set_y(self, y: np.ndarray) -> None:
+        """
+        Swap in values from _evaluate_into_back as self.y.
+        """
+        self.y = self._y_buffers.publish(y)
+        self._y_shared = False
+        # The array that was last decimated may be refilled.
+        self._line_key = None
 
     def change_values(self, x: float, y: float) -> None:
         """
@@ -110,36 +287,224 @@ class PlottyAnimator(Animator):
          x: x value that corresponds to the new y value.
          y: new y value
         """
+        if self._y_shared:
+            self.y = self.y.copy()
+            self._y_shared = False
         change_array(self.t, self.y, x, y)
+        self._line_key = None
+        self.mark_dirty()
 
     def set_parameters(self, parameters: List[float]) -> None:
         """
-        Set the parameters used for the function.
+        Set the parameters used for the function. Unless the curve has
+        been prefetched, it is evaluated by the evaluation scheduler
+        when there is one, and shown once a frame finds it finished.
+        Requests made while another is evaluating replace each other,
+        so only the newest is evaluated next.
 
         Parameters:
          parameters: the parameters of the function.
         """
+        if self._prefetcher is not None:
+            curve = self._prefetcher.lookup(tuple(parameters))
+            if curve is not None:
+                if self._scheduler is not None:
+                    self._scheduler.cancel()
+                self.params = tuple(parameters)
+                self.t, self.y = curve
+                self._y_params = self.params
+                self._y_shared = True
+                self._samples.invalidate()
+                self.mark_dirty()
+                return
+        if self._scheduler is not None:
+            function, t, params = self.function, self.t, tuple(parameters)
+            self._scheduler.submit(
+                lambda: self._evaluate_into_back(function, params, t),
+                (t, params))
+            self.params = params
+            self._samples.invalidate()
+            self.mark_dirty()
+            return
         try:
             # print(parameters)
-            y = self.function(self.t, *parameters)
+            with self.stats.measure("evaluation"):
+                y = self._evaluate_into_back(self.function, parameters)
         except TypeError as e:
             # if there is a float division by
             # zero maybe set the parameter to one?
             print(e)
             return
         self.params = tuple(parameters)
-        self.y = y
+        self._set_y(y)
+        self._y_params = self.params
+        self._samples.invalidate()
+        self.mark_dirty()
+
+    def on_parameters_settled(self) -> None:
+        """
+        Respond once the parameters have stopped changing. Adaptive
+        sampling points depend on the parameters, but set_parameters
+        keeps the old ones, so the view is sampled again. This finds
+        the jumps and asymptotes of the function with its new
+        parameters, and breaks the line there.
+        """
+        if self._sampler is not None and self.function.is_pointwise():
+            # The prefetched curves are of the same view, and are
+            # kept with their own sampling points.
+            self.resample(keep_prefetch=True)
+
+    def prefetch_parameter(self, index: int,
+                           values: Sequence[float]) -> None:
+        """
+        Start evaluating the function in the background for the given
+        values of one parameter, with the others held at their
+        current values, so that set_parameters can look them up.
+        This does nothing unless "Slider prefetch" is enabled
+        in the config.
+
+        Parameters:
+         index: the index of the parameter.
+         values: the values to evaluate at, the most
+         important first.
+        """
+        if self._prefetcher is not None and index < len(self.params):
+            self._prefetcher.request(self.function, self.t, self.params,
+                                     index, values)
+
+    def invalidate_prefetch(self) -> None:
+        """
+        Drop the prefetched curves, which must be done whenever the
+        function or the view changes.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.invalidate()
+
+    def update_number_of_points(self) -> bool:
+        """
+        Set the number of evenly spaced points from the width of the
+        plot in device pixels times points_per_pixel. The arrays they
+        are evaluated into are allocated a bucket_size at a time, so
+        small changes in size don't reallocate them. Call this when
+        the canvas is resized or moved to a screen with another
+        pixel density.
+
+        Returns:
+         Whether the number of points changed.
+        """
+        if not self.points_per_pixel:
+            return False
+        width = self.figure.get_axes()[0].bbox.width
+        n = max(int(width*self.points_per_pixel), 16)
+        changed = n != self.number_of_points
+        self.number_of_points = n
+        return changed
 
-    def on_plot_view_changed(self) -> None:
+    def on_plot_view_changed(self, coarse: bool = False) -> None:
         """
         Respond if the plot view is changed.
+
+        Parameters:
+         coarse: whether to use coarse samples, for example while
+         the view is still being zoomed. Call this again without
+         coarse once it has settled.
+        """
+        self.resample(reuse=True, coarse=coarse)
+
+    def resample(self, reuse: bool = False, coarse: bool = False,
+                 keep_prefetch: bool = False) -> None:
         """
-        xlim = self.figure.get_axes()[0].get_xlim()
-        n = len(self.t)
-        # print(xlim)
-        self.t = np.linspace(xlim[0], xlim[1], n)
-        self.line.set_xdata(self.t)
-        self.y = self.function(self.t, *self.params)
+        Choose the sampling points for the current view and evaluate
+        the function there. With adaptive sampling enabled, more points
+        are used where the function curves, and the line is broken at
+        jumps and asymptotes. Otherwise the points are evenly spaced.
+
+        If the view has only been moved, the samples that are
+        still visible are reused and only the newly visible
+        strips are evaluated. Samples are also kept in a tile cache,
+        so views that were seen before are not evaluated again. Numeric derivatives and antiderivatives are always
+        evaluated over the whole view.
+
+        Parameters:
+         reuse: whether the current samples are of the current
+         function, so that they can be reused if they are also
+         of the current parameters.
+         coarse: whether to use coarse_factor times fewer points.
+         keep_prefetch: whether the prefetched curves are still
+         of the current function and view.
+        """
+        ax = self.figure.get_axes()[0]
+        xlim, ylim = ax.get_xlim(), ax.get_ylim()
+        size = (ax.bbox.width, ax.bbox.height)
+        view_size = (xlim[1] - xlim[0], ylim[1] - ylim[0], size)
+        panned = reuse and self._view_size is not None and np.allclose(
+            view_size[:2], self._view_size[:2], rtol=1e-9, atol=0.0) and (
+            size == self._view_size[2]) and coarse == self._coarse
+        # Samples whose evaluation for new parameters hasn't
+        # finished can't be extended.
+        panned = panned and self._y_params == self.params
+        self._view_size = view_size
+        self._coarse = coarse
+        if not keep_prefetch:
+            self.invalidate_prefetch()
+        if self._scheduler is not None:
+            # What it is evaluating is replaced by the new samples.
+            self._scheduler.cancel()
+        if not reuse:
+            self._samples.invalidate()
+        with self.stats.measure("evaluation"):
+            self._sample(xlim, ylim, size, panned, coarse)
+        self._y_params = self.params
+        self._y_shared = False
+        self.update_line()
+        self.mark_dirty()
+
+    def _sample(self, xlim: Tuple[float, float], ylim: Tuple[float, float],
+                size: Tuple[float, float], panned: bool,
+                coarse: bool) -> None:
+        """
+        Set self.t and self.y for the view, for resample.
+        """
+        n = self.number_of_points
+        sampler = self._sampler
+        if coarse:
+            n = max(n//self.coarse_factor, 16)
+            if sampler is not None:
+                sampler = AdaptiveSampler(
+                    max(sampler.coarse_points//self.coarse_factor, 16),
+                    max(sampler.max_points//self.coarse_factor, 16),
+                    sampler.tolerance*self.coarse_factor,
+                    sampler.min_width*self.coarse_factor)
+        if sampler is not None and self.function.is_pointwise():
+            if self._tiles is not None:
+                key = (self.function.get_key(), self.params)
+                self.t, self.y = self._tiles.sample_adaptive(
+                    sampler, self.function, self.params, key,
+                    xlim, ylim, size)
+            elif panned:
+                self.t, self.y = sampler.extend(
+                    self.function, self.params, self.t, self.y,
+                    xlim, ylim, size)
+            else:
+                self.t, self.y = sampler.sample(
+                    self.function, self.params, xlim, ylim, size)
+        elif self.function.is_pointwise() and self._tiles is not None:
+            key = (self.function.get_key(), self.params)
+            self.t, self.y = self._tiles.sample(
+                lambda t: self.evaluate(self.function, self.params, t),
+                key, xlim, n)
+        elif self.function.is_pointwise():
+            self.t, self.y = self._samples.update(
+                lambda t: self.evaluate(self.function, self.params, t),
+                xlim, n)
+        else:
+            if self._ramp is None or len(self._ramp) != n:
+                self._ramp = np.arange(n, dtype=float)
+            t = self._t_buffers.acquire((n,))
+            np.multiply(self._ramp, (xlim[1] - xlim[0])/(n - 1), out=t)
+            t += xlim[0]
+            self.t = self._t_buffers.publish(t)
+            self._set_y(self._evaluate_into_back(self.function, self.params))
 
     def set_title(self, function_name: str) -> None:
         """
@@ -148,30 +513,124 @@ class PlottyAnimator(Animator):
         Parameters:
          function_name: the name of the function.
         """
-        self.toggle_blit()
         ax = self.figure.get_axes()[0]
         if "&" in function_name or len(function_name) > 150:
-            ax.set_title("f(x)")
+            # Keep the marker that the function is numeric.
+            suffix = " (numeric)"
+            if function_name.endswith(suffix):
+                ax.set_title("f(x)" + suffix)
+            else:
+                ax.set_title("f(x)")
         else:
             ax.set_title(r"%s" %(function_name))
         # ax.set_title(r"%s" %(function_name))
-        self.toggle_blit()
+        self.mark_dirty()
 
     def differentiate_function(self) -> None:
         """
-        Differentiate the function.
+        Differentiate the function. Unless the derivative is in the
+        disk cache it is computed in another process, and applied
+        when poll_symbolic_job finds that it is done.
         """
-        old_function_name = self.function.get_function_name()
-        self.function.derivative()
-        self._diff_helper(old_function_name)
+        self._start_symbolic_job("derivative")
 
     def antidifferentiate_function(self) -> None:
         """
-        Antidifferentiate the function.
+        Antidifferentiate the function. Unless the antiderivative is
+        in the disk cache it is computed in another process, and applied
+        when poll_symbolic_job finds that it is done.
+        """
+        self._start_symbolic_job("antiderivative")
+
+    def _start_symbolic_job(self, operation: str) -> None:
         """
+        Start transforming the function, unless another
+        transformation is still running.
+
+        Parameters:
+         operation: either "derivative" or "antiderivative".
+        """
+        if self.is_symbolic_job_running():
+            return
         old_function_name = self.function.get_function_name()
-        self.function.antiderivative()
+        if self.function.is_numeric():
+            # Once part of the function is numeric sympy can't help.
+            self.function.apply_numeric(operation)
+            self._diff_helper(old_function_name)
+            return
+        if self.function.load_transform(operation):
+            self._diff_helper(old_function_name)
+            return
+        job = self.function.transform_job(operation, self.symbolic_timeout)
+        job.start()
+        self._symbolic_job = job
+        self._symbolic_job_function = self.function
+
+    def is_symbolic_job_running(self) -> bool:
+        """
+        Check whether a derivative or antiderivative is being computed.
+        """
+        return self._symbolic_job is not None
+
+    def has_exiting_symbolic_jobs(self) -> bool:
+        """
+        Check whether the worker processes of finished derivatives
+        or antiderivatives are still exiting. They are cleaned up
+        by poll_symbolic_job, so keep calling it until they are not.
+        """
+        return len(self._exiting_jobs) > 0
+
+    def poll_symbolic_job(self) -> str:
+        """
+        Check on the running derivative or antiderivative without
+        blocking, and apply the result if it is done. Call this
+        periodically, for example from a timer. If sympy fails or
+        takes too long, the result is computed numerically instead.
+
+        Returns:
+         The status of the job, see SymbolicJob, or "idle" if
+         there is none.
+        """
+        self._exiting_jobs = [job for job in self._exiting_jobs
+                              if not job.exited()]
+        job = self._symbolic_job
+        if job is None:
+            return "idle"
+        status = job.poll()
+        if status == "running":
+            return status
+        self._symbolic_job = None
+        self._exiting_jobs.append(job)
+        function = self._symbolic_job_function
+        self._symbolic_job_function = None
+        if status == "error":
+            print(job.error)
+        elif status == "timeout":
+            print("The %s took longer than %g s, so it is computed "
+                  "numerically" % (job.operation, job.timeout))
+        if function is not self.function or status == "cancelled":
+            return status
+        old_function_name = function.get_function_name()
+        if status == "done":
+            try:
+                function.apply_transform(job.operation, job.result)
+            except Exception as e:
+                print(e)
+                function.apply_numeric(job.operation)
+        else:
+            function.apply_numeric(job.operation)
         self._diff_helper(old_function_name)
+        return status
+
+    def cancel_symbolic_job(self) -> None:
+        """
+        Cancel the running derivative or antiderivative, if any.
+        """
+        if self._symbolic_job is not None:
+            self._symbolic_job.cancel()
+            self._exiting_jobs.append(self._symbolic_job)
+            self._symbolic_job = None
+            self._symbolic_job_function = None
 
     def _diff_helper(self, old_function_name: str) -> None:
         """
@@ -187,9 +646,12 @@ class PlottyAnimator(Animator):
         if not is_defined_at_values(self.function, np.pi, *params):
             self.set_function(old_function_name)
             return
-        self.set_title("$f(x) = %s$" % self.function.latex_repr)
-        self.y = self.function(self.t, 
-                          *self.params)
+        if self.function.is_numeric():
+            self.set_title("$f(x) = %s$ (numeric)"
+                           % self.function.latex_repr)
+        else:
+            self.set_title("$f(x) = %s$" % self.function.latex_repr)
+        self.resample()
 
     def set_function(self, function_name: str) -> None:
         """
@@ -210,9 +672,9 @@ class PlottyAnimator(Animator):
             params = tuple(d[key] for key in d)
             if not is_defined_at_values(function, np.pi, *params):
                 return
+            self.cancel_symbolic_job()
             self.set_title("$f(x) = %s$" % function.latex_repr)
             self.params = params
             self.function = function
             # print(default_values)
-            self.y = function(self.t, 
-                              *self.params)
+            self.resample()
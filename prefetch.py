@@ -0,0 +1,242 @@
+# Copyright (C) 2020 Mark (marl0ny)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Background precomputation of the curves for the positions of a slider,
+so that dragging the slider only has to look up an array.
+"""
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Sequence, Tuple, Union
+
+
+class SliderPrefetcher:
+    """
+    Evaluate a function on a worker thread for many values of one
+    parameter, with the other parameters held fixed, and keep the
+    results in a cache of bounded size. Each curve is kept with the
+    sampling points it was evaluated at, so it stays usable when
+    those are changed for the same view. Only one parameter is
+    prefetched at a time. A new request replaces the one that is
+    running, and invalidate drops everything, which must be done
+    whenever the function or the view changes.
+
+    Attributes:
+     max_bytes [int]: the maximum total size of the cached curves.
+     batch_size [int]: the number of curves evaluated at a time.
+     hits [int]: number of lookups that found a curve.
+     misses [int]: number of lookups that did not.
+
+    >>> from sympy import abc
+    >>> from functions import FunctionRtoR
+    >>> f = FunctionRtoR("a*x + b", abc.x)
+    >>> t = np.linspace(0.0, 1.0, 3)
+    >>> prefetcher = SliderPrefetcher(1 << 20)
+    >>> prefetcher.request(f, t, (1.0, 0.0), 1, [0.0, 1.0, 2.0])
+    >>> prefetcher.wait()
+    >>> x, y = prefetcher.lookup((1.0, 2.0))
+    >>> x is t, y
+    (True, array([2. , 2.5, 3. ]))
+    >>> prefetcher.lookup((2.0, 2.0)) is None
+    True
+    >>> prefetcher.close()
+    """
+
+    def __init__(self, max_bytes: int, batch_size: int = 8) -> None:
+        """
+        The initializer, which starts the worker thread.
+
+        Parameters:
+         max_bytes: the maximum total size of the cached curves.
+         batch_size: the number of curves evaluated at a time. The
+         worker only notices new requests between batches.
+        """
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._nbytes = 0
+        self._generation = 0
+        # The parameter index and parameter values of the curves
+        # in the cache.
+        self._context = None
+        self._job = None
+        self._closed = False
+        self._busy = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, function: Any, t: np.ndarray,
+                params: Sequence[float], index: int,
+                values: Sequence[float]) -> None:
+        """
+        Start evaluating the function for each of the given values of
+        one parameter. Values whose curves are already cached
+        are skipped, and the rest are evaluated in the given order,
+        so the closest ones to the current value should come first.
+
+        Parameters:
+         function: the function, which must have a sweep method
+         like FunctionRtoR.
+         t: the sampling points.
+         params: the current parameters.
+         index: the index of the parameter to vary.
+         values: the values of that parameter.
+        """
+        context = (index, self._others(params, index))
+        with self._condition:
+            if context != self._context:
+                self._clear()
+                self._context = context
+            values = [v for v in values if v not in self._cache]
+            self._generation += 1
+            self._job = (self._generation, function, t, tuple(params),
+                         index, values) if values else None
+            self._condition.notify()
+
+    def lookup(self, params: Sequence[float]
+               ) -> Union[Tuple[np.ndarray, np.ndarray], None]:
+        """
+        Get the cached curve for the given parameters, if there is one.
+        The returned arrays are shared with the cache and must not be
+        modified.
+
+        Parameters:
+         params: the parameters.
+
+        Returns:
+         The sampling points and the values of the function
+         there, or None.
+        """
+        with self._condition:
+            curve = None
+            if self._context is not None:
+                index, others = self._context
+                if (index < len(params)
+                        and self._others(params, index) == others):
+                    curve = self._cache.get(params[index])
+            if curve is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(params[index])
+            self.hits += 1
+            return curve
+
+    def invalidate(self) -> None:
+        """
+        Drop all cached curves and stop the current request.
+        """
+        with self._condition:
+            self._generation += 1
+            self._job = None
+            self._context = None
+            self._clear()
+
+    def wait(self) -> None:
+        """
+        Block until the current request is finished.
+        """
+        with self._condition:
+            while self._job is not None or self._busy:
+                self._condition.wait()
+
+    def close(self) -> None:
+        """
+        Stop the worker thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._job = None
+            self._condition.notify_all()
+        self._thread.join()
+
+    @staticmethod
+    def _others(params: Sequence[float], index: int) -> tuple:
+        """
+        Get the parameters other than the one at index.
+        """
+        return tuple(params[:index]) + tuple(params[index + 1:])
+
+    def _clear(self) -> None:
+        """
+        Empty the cache. The lock must be held.
+        """
+        self._cache.clear()
+        self._nbytes = 0
+
+    def _store(self, value: float, t: np.ndarray,
+               curve: np.ndarray) -> None:
+        """
+        Add a curve and its sampling points to the cache, evicting the
+        least recently used curves if it is full. Only the curves count
+        to max_bytes, since the sampling points are shared by all the
+        curves of a request. The lock must be held.
+        """
+        if curve.nbytes > self.max_bytes:
+            return
+        # The curve is a row of the whole batch, which a view
+        # would keep alive.
+        curve = curve.copy()
+        self._cache[value] = (t, curve)
+        self._nbytes += curve.nbytes
+        while self._nbytes > self.max_bytes:
+            _, (_, old) = self._cache.popitem(last=False)
+            self._nbytes -= old.nbytes
+
+    def _run(self) -> None:
+        """
+        The worker thread, which evaluates one batch of the current
+        request at a time.
+        """
+        while True:
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+                while self._job is None and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                generation, function, t, params, index, values = self._job
+                batch = values[: self.batch_size]
+                rest = values[self.batch_size:]
+                self._job = ((generation, function, t, params, index, rest)
+                             if rest else None)
+                self._busy = True
+            args = list(params)
+            args[index] = np.array(batch)
+            try:
+                with np.errstate(all="ignore"):
+                    curves = function.sweep(t, *args)
+            except Exception as e:
+                print(e)
+                with self._condition:
+                    if self._generation == generation:
+                        self._job = None
+                continue
+            with self._condition:
+                if self._generation == generation:
+                    for value, curve in zip(batch, curves):
+                        self._store(value, t, curve)
+
+
+if __name__ == "__main__":
+    import doctest
+    import functions
+    # Keep the doctests from reading or writing the disk cache.
+    functions.disk_cache = None
+    doctest.testmod()
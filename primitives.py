@@ -0,0 +1,254 @@
+# Copyright (C) 2020 Mark (marl0ny)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Vectorized builtin functions that can be used when entering a function,
+such as rect(x) or sawtooth(x). Every function in the registry is passed
+to lambdify, works on both floats and numpy arrays, and accepts an
+optional out array so that it can write its result without allocating.
+"""
+import numpy as np
+from typing import Callable, Dict, Union
+
+
+Array = Union[np.ndarray, float]
+
+# Functions that are available by name when parsing input.
+registry: Dict[str, Callable] = {}
+
+
+def register_primitive(f: Callable, name: str = None) -> Callable:
+    """
+    Add a function to the registry.
+
+    Parameters:
+     f: the function.
+     name: the name used in input. Defaults to the name of f.
+
+    Returns:
+     f itself, so that this can be used as a decorator.
+    """
+    registry[f.__name__ if name is None else name] = f
+    return f
+
+
+def _output(x: Array, out: Union[np.ndarray, None]) -> np.ndarray:
+    """
+    Get the array that a primitive writes its result into.
+    """
+    if out is None:
+        return np.empty(np.shape(x))
+    return out
+
+
+def _result(out: np.ndarray) -> Array:
+    """
+    Get the return value of a primitive, which is a float
+    if the input was a float.
+    """
+    return out if out.ndim > 0 else out[()]
+
+
+@register_primitive
+def rect(x: Array, out: np.ndarray = None) -> Array:
+    """
+    Rectangle function. Defined as
+     rect(x) = 1 if x^2 <= 1 else 0
+
+    Parameters:
+     x: input values.
+     out: optional array for the output.
+
+    Returns
+     rect(x)
+
+    >>> rect(np.array([-2.0, -1.0, 0.0, 0.5, 1.5]))
+    array([0., 1., 1., 1., 0.])
+    >>> float(rect(0.25))
+    1.0
+    """
+    out = _output(x, out)
+    np.absolute(x, out=out)
+    np.less_equal(out, 1.0, out=out)
+    return _result(out)
+
+
+@register_primitive
+def step(x: Array, out: np.ndarray = None) -> Array:
+    """
+    Step function. Defined as
+     step(x) = 1 if x >= 0 else 0
+
+    Parameters:
+     x: input values.
+     out: optional array for the output.
+
+    >>> step(np.array([-1.0, 0.0, 1.0]))
+    array([0., 1., 1.])
+    """
+    out = _output(x, out)
+    np.greater_equal(x, 0.0, out=out)
+    return _result(out)
+
+
+@register_primitive
+def triangle(x: Array, out: np.ndarray = None) -> Array:
+    """
+    Triangle function. Defined as
+     triangle(x) = max(1 - |x|, 0)
+
+    Parameters:
+     x: input values.
+     out: optional array for the output.
+
+    >>> triangle(np.array([-2.0, -0.5, 0.0, 0.75]))
+    array([0.  , 0.5 , 1.  , 0.25])
+    """
+    out = _output(x, out)
+    np.absolute(x, out=out)
+    np.subtract(1.0, out, out=out)
+    np.maximum(out, 0.0, out=out)
+    return _result(out)
+
+
+@register_primitive
+def sawtooth(x: Array, out: np.ndarray = None) -> Array:
+    """
+    Sawtooth wave with a period of 2 pi, rising from -1 at x = 0
+    to 1 at x = 2 pi.
+
+    Parameters:
+     x: input values.
+     out: optional array for the output.
+
+    >>> sawtooth(np.array([0.0, np.pi/2, np.pi, 2.0*np.pi]))
+    array([-1. , -0.5,  0. , -1. ])
+    """
+    out = _output(x, out)
+    np.divide(x, 2.0*np.pi, out=out)
+    np.remainder(out, 1.0, out=out)
+    np.multiply(out, 2.0, out=out)
+    np.subtract(out, 1.0, out=out)
+    return _result(out)
+
+
+@register_primitive
+def square(x: Array, out: np.ndarray = None) -> Array:
+    """
+    Square wave with a period of 2 pi, which is 1
+    for the first half of each period and -1 for the second.
+
+    Parameters:
+     x: input values.
+     out: optional array for the output.
+
+    >>> square(np.array([0.0, np.pi/2, 3.0*np.pi/2]))
+    array([ 1.,  1., -1.])
+    """
+    out = _output(x, out)
+    np.divide(x, 2.0*np.pi, out=out)
+    np.remainder(out, 1.0, out=out)
+    np.less(out, 0.5, out=out)
+    np.multiply(out, 2.0, out=out)
+    np.subtract(out, 1.0, out=out)
+    return _result(out)
+
+
+# sympy parses sinc itself and lambdify translates it to numpy.sinc,
+# which registering this would shadow, so it is left out of the registry.
+def sinc(x: Array, out: np.ndarray = None) -> Array:
+    """
+    Unnormalized sinc function, sin(x)/x, which is 1 at x = 0.
+    This is the same definition as sympy uses.
+
+    Parameters:
+     x: input values.
+     out: optional array for the output.
+
+    >>> sinc(np.array([0.0, np.pi/2]))
+    array([1.        , 0.63661977])
+    """
+    out = _output(x, out)
+    zero = np.equal(x, 0.0)
+    np.sin(x, out=out)
+    np.divide(out, x, out=out, where=~zero)
+    np.copyto(out, 1.0, where=zero)
+    return _result(out)
+
+
+@register_primitive
+def clamp(x: Array, low: float, high: float,
+          out: np.ndarray = None) -> Array:
+    """
+    Clamp the input values to the interval [low, high].
+
+    Parameters:
+     x: input values.
+     low: the lowest value.
+     high: the highest value.
+     out: optional array for the output.
+
+    >>> clamp(np.array([-2.0, 0.5, 2.0]), -1.0, 1.0)
+    array([-1. ,  0.5,  1. ])
+    """
+    out = _output(x, out)
+    np.clip(x, low, high, out=out)
+    return _result(out)
+
+
+@register_primitive
+def between(x: Array, low: float, high: float,
+            out: np.ndarray = None) -> Array:
+    """
+    Indicator function of the interval [low, high]. Multiply
+    by this to build piecewise functions, for example
+    x*between(x, 0, 1) + between(x, 1, 2).
+
+    Parameters:
+     x: input values.
+     low: start of the interval.
+     high: end of the interval.
+     out: optional array for the output.
+
+    >>> between(np.array([-1.0, 0.0, 0.5, 1.0, 2.0]), 0.0, 1.0)
+    array([0., 1., 1., 1., 0.])
+    """
+    out = _output(x, out)
+    np.greater_equal(x, low, out=out)
+    np.multiply(out, np.less_equal(x, high), out=out)
+    return _result(out)
+
+
+@register_primitive
+def ramp(x: Array, out: np.ndarray = None) -> Array:
+    """
+    Ramp function. Defined as
+     ramp(x) = max(x, 0)
+
+    Parameters:
+     x: input values.
+     out: optional array for the output.
+
+    >>> ramp(np.array([-1.0, 2.0]))
+    array([0., 2.])
+    """
+    out = _output(x, out)
+    np.maximum(x, 0.0, out=out)
+    return _result(out)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,223 @@
+# Copyright (C) 2020 Mark (marl0ny)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Timing of each animation frame, split into the stages
+that the time was spent in.
+"""
+import json
+import numpy as np
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Iterator, Sequence
+
+
+# The stages that the time of a frame is split into.
+stages = ("update", "evaluation", "decimation", "draw", "events")
+
+
+class FrameStats:
+    """
+    A ring buffer of the time spent in each stage of the most recent
+    frames. Time is added to the current frame with measure or add,
+    and end_frame stores the current frame and starts the next.
+    Stages can be nested, and the time of a nested stage is not
+    counted in the stage around it. Things other than time, such as
+    the number of events that were merged, are kept as counters.
+
+    Attributes:
+     size [int]: the number of frames that are kept.
+     count [int]: the total number of frames recorded.
+     counters [dict]: totals kept with increment.
+
+    >>> stats = FrameStats(4)
+    >>> for i in range(6):
+    ...     stats.add("update", 0.001*i)
+    ...     stats.end_frame()
+    >>> stats.count, len(stats.records())
+    (6, 4)
+    >>> stats.percentiles("update", (50,))
+    {50: 0.0035}
+    >>> with stats.measure("events"):
+    ...     with stats.measure("evaluation"):
+    ...         pass
+    >>> stats.current["events"] >= 0.0
+    True
+    >>> stats.increment("coalesced events", 3)
+    >>> stats.counters
+    {'coalesced events': 3}
+    """
+
+    def __init__(self, size: int = 600) -> None:
+        """
+        The initializer.
+
+        Parameters:
+         size: the number of frames that are kept.
+        """
+        self.size = size
+        self.count = 0
+        # The time at which each frame ended, followed by the
+        # time spent in each stage.
+        self._records = np.zeros((size, len(stages) + 1))
+        self.current = dict.fromkeys(stages, 0.0)
+        self.counters = {}
+        self._stack = []
+
+    def add(self, stage: str, seconds: float) -> None:
+        """
+        Add time to a stage of the current frame.
+
+        Parameters:
+         stage: one of the stages.
+         seconds: the time.
+        """
+        self.current[stage] += seconds
+
+    def increment(self, counter: str, amount: int = 1) -> None:
+        """
+        Add to a counter, which starts at zero.
+
+        Parameters:
+         counter: the name of the counter.
+         amount: the amount to add.
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def set_counter(self, counter: str, value: int) -> None:
+        """
+        Set a counter, for things that are counted elsewhere.
+
+        Parameters:
+         counter: the name of the counter.
+         value: the value.
+        """
+        self.counters[counter] = value
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        """
+        Add the time spent in a with block to a stage
+        of the current frame.
+
+        Parameters:
+         stage: one of the stages.
+        """
+        t = perf_counter()
+        if self._stack:
+            # Stop the clock of the stage around this one.
+            outer, start = self._stack[-1]
+            self.current[outer] += t - start
+        self._stack.append((stage, t))
+        try:
+            yield
+        finally:
+            t = perf_counter()
+            _, start = self._stack.pop()
+            self.current[stage] += t - start
+            if self._stack:
+                self._stack[-1] = (self._stack[-1][0], t)
+
+    def end_frame(self) -> None:
+        """
+        Store the current frame and start the next one.
+        """
+        record = self._records[self.count % self.size]
+        record[0] = perf_counter()
+        record[1:] = [self.current[stage] for stage in stages]
+        self.current = dict.fromkeys(stages, 0.0)
+        self.count += 1
+
+    def records(self) -> np.ndarray:
+        """
+        Get the stored frames from the oldest to the newest, as an
+        array with a row for each frame. The first column is the
+        time at which the frame ended, and the others are the
+        time spent in each stage.
+        """
+        n = min(self.count, self.size)
+        start = self.count % self.size if self.count > self.size else 0
+        return np.roll(self._records, -start, axis=0)[:n]
+
+    def percentiles(self, stage: str = "total",
+                    q: Sequence[float] = (50, 95, 99)
+                    ) -> Dict[float, float]:
+        """
+        Get percentiles of the time spent in a stage, over the stored
+        frames.
+
+        Parameters:
+         stage: one of the stages, or "total" for the sum of them.
+         q: the percentiles.
+
+        Returns:
+         A dict from each percentile to the time in seconds.
+        """
+        records = self.records()
+        if len(records) == 0:
+            return {p: 0.0 for p in q}
+        if stage == "total":
+            values = np.sum(records[:, 1:], axis=1)
+        else:
+            values = records[:, 1 + stages.index(stage)]
+        return {p: float(v) for p, v in zip(q, np.percentile(values, q))}
+
+    def fps(self, window: float = 1.0) -> float:
+        """
+        Get the number of frames that ended in the last window seconds,
+        divided by the window.
+        """
+        ends = self.records()[:, 0]
+        return float(np.sum(ends > perf_counter() - window))/window
+
+    def summary(self) -> str:
+        """
+        Get a short text summary, used for the overlay.
+        """
+        lines = ["%.0f fps" % self.fps()]
+        for stage in stages + ("total",):
+            p = self.percentiles(stage)
+            lines.append("%-10s %6.2f %6.2f %6.2f ms"
+                         % (stage, 1e3*p[50], 1e3*p[95], 1e3*p[99]))
+        for counter in self.counters:
+            lines.append("%s: %d" % (counter, self.counters[counter]))
+        return "\n".join(lines)
+
+    def dump(self, path: str) -> None:
+        """
+        Write the stored frames to a file, as JSON if the file name
+        ends with .json and as CSV otherwise.
+
+        Parameters:
+         path: the file name.
+        """
+        records = self.records()
+        names = ("end",) + stages
+        if path.endswith(".json"):
+            data = {"frames": [dict(zip(names, map(float, record)))
+                               for record in records],
+                    "percentiles": {stage: self.percentiles(stage)
+                                    for stage in stages + ("total",)},
+                    "counters": self.counters}
+            with open(path, "w") as f:
+                json.dump(data, f, indent=1)
+        else:
+            np.savetxt(path, records, delimiter=",",
+                       header=",".join(names), comments="")
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
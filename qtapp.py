@@ -17,13 +17,9 @@
 Main Qt App.
 
 Issues:
- -When moving the plot view or zooming in or out 
- the plot likes to flicker.
- -When rescaling the plot, some
- artefacts may appear along the right edge of the plot.
- -The quality of the plot may worsen as one zoomes out.
- This is caused by the number of sampling points of the function
- being fixed and finite.
+ -Numeric derivatives and antiderivatives are sampled at a fixed
+ number of evenly spaced points, so their plot may worsen
+ as one zooms out.
 
 Features to add:
  -Get the location of the mouse pointer.
@@ -37,14 +33,26 @@ Features to add:
 import sys
 from PyQt5 import QtWidgets, QtCore, QtGui
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+from matplotlib.colors import to_hex
 from plotty_animation import PlottyAnimator
 from typing import Any, Tuple, Union
-from numpy import linspace
+from numpy import asarray, linspace
 
 
 class Canvas(FigureCanvasQTAgg):
     """
     The canvas.
+
+    Mouse moves and wheel turns are added up between frames, and
+    applied to the view once at the start of the next frame, however
+    many events there were. The wheel zooms about the mouse pointer,
+    by an amount proportional to how far it turned, so small steps
+    from trackpads and fine wheels zoom smoothly. While zooming the
+    plot is sampled coarsely, and it is sampled fully once the wheel
+    has been still for a moment. While the plot is dragged, the last
+    rendered image of the plot is shown moved by the distance dragged,
+    so that it follows the mouse on the next paint. The exact render
+    replaces the moved image once the frame is drawn.
     """
 
     def __init__(self, parent: QtWidgets.QMainWindow, rect: QtCore.QRect) -> None:
@@ -65,21 +73,47 @@ class Canvas(FigureCanvasQTAgg):
         self._DIFF = 0
         self._ANTIDIFF = 1
         self._TITLE = 2
+        self._CANCEL = 3
         self._menu_dict = {"Differentiate w.r.t. x": self._DIFF, 
                            "Antidifferentiate w.r.t. x": self._ANTIDIFF,
                            "Substitute title "
-                           "parameters with values": self._TITLE}
+                           "parameters with values": self._TITLE,
+                           "Cancel": self._CANCEL}
         self._menu_list = [key for key in self._menu_dict]
         self._menu = QtWidgets.QMenu(parent)
         # self._menu.setWindowFlag(QtCore.Qt.FramelessWindowHint)
         for item in self._menu_list:
             self._menu.addAction(item)
         self._menu.triggered.connect(self.on_right_click_popup)
+        # Checks on derivatives and antiderivatives that are being
+        # computed in another process.
+        self._job_timer = QtCore.QTimer(self)
+        self._job_timer.setInterval(50)
+        self._job_timer.timeout.connect(self.poll_symbolic_job)
+        self._busy_cursor = False
         self._MOUSE_DEFAULT_ACTION = 0
         self._MOUSE_MOVE_PLOT = 1
         self._MOUSE_EDIT_FUNCTION = 2
         self._mouse_usage = self._MOUSE_MOVE_PLOT
         self._prev_mouse_position = []
+        # The axes limits and position of the last full render, and
+        # a copy of that render with them while the plot is dragged.
+        self._rendered_view = None
+        self._pan_preview = None
+        self.mpl_connect("draw_event", self._on_draw)
+        # The distance dragged in pixels and the zoom since the last
+        # frame, and the number of events they came from. The zoom
+        # maps each limit u to scale*u + offset.
+        self._pending_pan = [0, 0]
+        self._pending_zoom = (1.0, 0.0, 0.0)
+        self._pending_events = 0
+        self._ani.add_frame_callback(self.apply_view_changes)
+        # Samples the view fully once zooming has stopped.
+        self._zoom_settle_timer = QtCore.QTimer(self)
+        self._zoom_settle_timer.setSingleShot(True)
+        self._zoom_settle_timer.setInterval(150)
+        self._zoom_settle_timer.timeout.connect(
+            self._ani.on_plot_view_changed)
 
     def _mouse_coordinates_transform(self, 
                                      x: int, y: int) -> Tuple[float, float]:
@@ -101,6 +135,8 @@ class Canvas(FigureCanvasQTAgg):
         pixel_xlim = [ax.bbox.xmin, ax.bbox.xmax]
         pixel_ylim = [ax.bbox.ymin, ax.bbox.ymax]
         height = self.figure.bbox.ymax
+        # The bounding boxes are in physical pixels.
+        x, y = x*self.device_pixel_ratio, y*self.device_pixel_ratio
         mx = (xlim[1] - xlim[0])/(pixel_xlim[1] - pixel_xlim[0])
         my = (ylim[1] - ylim[0])/(pixel_ylim[1] - pixel_ylim[0])
         x = (x - pixel_xlim[0])*mx + xlim[0]
@@ -120,17 +156,16 @@ class Canvas(FigureCanvasQTAgg):
         if qt_event.buttons() == QtCore.Qt.LeftButton:
             if (self._mouse_usage == self._MOUSE_MOVE_PLOT
                 or self._mouse_usage == self._MOUSE_DEFAULT_ACTION):
-                x, y = self._mouse_coordinates_transform(x, y)
                 if self._prev_mouse_position != []:
                     x_prev, y_prev = self._prev_mouse_position
-                    dx = x - x_prev
-                    dy = y - y_prev
-                    # self.setCursor()
-                    self._ani.move_axes(self._ani.figure.get_axes()[0],
-                                        -dx, -dy)
-                    self._ani.on_plot_view_changed()
-                else:
-                    self._prev_mouse_position = [x, y]
+                    if (x, y) != (x_prev, y_prev):
+                        # self.setCursor()
+                        self._pending_pan[0] += x - x_prev
+                        self._pending_pan[1] += y - y_prev
+                        self._pending_events += 1
+                        self._show_pan_preview()
+                        self._ani.mark_dirty()
+                self._prev_mouse_position = [x, y]
             elif self._mouse_usage == self._MOUSE_EDIT_FUNCTION:
                 x, y = self._mouse_coordinates_transform(x, y)
                 self._ani.change_values(x, y)
@@ -139,6 +174,75 @@ class Canvas(FigureCanvasQTAgg):
         if qt_event.buttons() == QtCore.Qt.RightButton:
             pass
 
+    def _view(self) -> tuple:
+        """
+        Get the axes limits and position of the plot.
+        """
+        ax = self.figure.get_axes()[0]
+        return ax.get_xlim(), ax.get_ylim(), tuple(ax.bbox.bounds)
+
+    def _on_draw(self, event) -> None:
+        """
+        The whole figure has been drawn, so the render is exact
+        and the moved image is no longer needed.
+        """
+        self._rendered_view = self._view()
+        self._pan_preview = None
+
+    def _show_pan_preview(self) -> None:
+        """
+        Paint the last render of the plot moved to where the view
+        is being dragged to. The paint is scheduled rather than done
+        right away, so that Qt merges it with other paint requests.
+        """
+        if self._rendered_view is None:
+            return
+        if self._pan_preview is None:
+            buffer = asarray(self.buffer_rgba())
+            height, width = buffer.shape[:2]
+            image = QtGui.QImage(buffer.data, width, height,
+                                 QtGui.QImage.Format_RGBA8888).copy()
+            image.setDevicePixelRatio(self.device_pixel_ratio)
+            self._pan_preview = (image, self._rendered_view)
+        self.update()
+
+    def _paint_pan_preview(self) -> bool:
+        """
+        Paint the moved image of the plot, if the plot has only been
+        moved since it was rendered.
+
+        Returns:
+         Whether it was painted.
+        """
+        image, (xlim, ylim, bounds) = self._pan_preview
+        new_xlim, new_ylim, new_bounds = self._view()
+        # Where the view is about to be moved to.
+        move_x, move_y = self._pan_distance(*self._pending_pan)
+        new_xlim = (new_xlim[0] + move_x, new_xlim[1] + move_x)
+        new_ylim = (new_ylim[0] + move_y, new_ylim[1] + move_y)
+        x0, y0, width, height = bounds
+        if (new_bounds != bounds
+                or abs((new_xlim[1] - new_xlim[0]) - (xlim[1] - xlim[0]))
+                > 1e-9*abs(xlim[1] - xlim[0])
+                or abs((new_ylim[1] - new_ylim[0]) - (ylim[1] - ylim[0]))
+                > 1e-9*abs(ylim[1] - ylim[0])):
+            return False
+        ratio = self.device_pixel_ratio
+        # The distance moved in logical pixels, with y pointing down.
+        dx = (xlim[0] - new_xlim[0])*width/(xlim[1] - xlim[0])/ratio
+        dy = (new_ylim[0] - ylim[0])*height/(ylim[1] - ylim[0])/ratio
+        ax = self.figure.get_axes()[0]
+        rect = QtCore.QRectF(x0/ratio,
+                             (self.figure.bbox.height - y0 - height)/ratio,
+                             width/ratio, height/ratio)
+        painter = QtGui.QPainter(self)
+        painter.drawImage(QtCore.QPointF(0.0, 0.0), image)
+        painter.setClipRect(rect)
+        painter.fillRect(rect, QtGui.QColor(to_hex(ax.get_facecolor())))
+        painter.drawImage(QtCore.QPointF(dx, dy), image)
+        painter.end()
+        return True
+
     def on_right_click_popup(self, action: QtWidgets.QAction) -> None:
         """
         Perform an action when one selects from the right click popup.
@@ -151,10 +255,40 @@ class Canvas(FigureCanvasQTAgg):
         print(action_val)
         if action_val == self._DIFF:
             self._ani.differentiate_function()
+            self._watch_symbolic_job()
         elif action_val == self._ANTIDIFF:
             self._ani.antidifferentiate_function()
+            self._watch_symbolic_job()
         elif action_val == self._TITLE:
             pass
+        elif action_val == self._CANCEL:
+            self._ani.cancel_symbolic_job()
+            self.poll_symbolic_job()
+
+    def _watch_symbolic_job(self) -> None:
+        """
+        If a derivative or antiderivative is being computed, show
+        a busy cursor and start checking on it.
+        """
+        if self._ani.is_symbolic_job_running() and not self._busy_cursor:
+            QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.BusyCursor)
+            self._busy_cursor = True
+            self._job_timer.start()
+
+    def poll_symbolic_job(self) -> None:
+        """
+        Check on the derivative or antiderivative being computed,
+        and restore the cursor once it has finished. Checking
+        continues until its worker process has exited.
+        """
+        if not self._job_timer.isActive():
+            return
+        if self._ani.poll_symbolic_job() != "running" and self._busy_cursor:
+            QtWidgets.QApplication.restoreOverrideCursor()
+            self._busy_cursor = False
+        if not (self._ani.is_symbolic_job_running()
+                or self._ani.has_exiting_symbolic_jobs()):
+            self._job_timer.stop()
 
     def set_mouse_usage(self, usage: int) -> None:
         """
@@ -180,8 +314,7 @@ class Canvas(FigureCanvasQTAgg):
             #     # self._menu.showTearOffMenu()
             # else:
             #     self._menu.setTearOffEnabled(False)
-        x, y = self._mouse_coordinates_transform(qt_event.x(), qt_event.y())
-        self._prev_mouse_position = [x, y]
+        self._prev_mouse_position = [qt_event.x(), qt_event.y()]
         self._mouse_handler(qt_event)
         self.setMouseTracking(True)
 
@@ -211,13 +344,97 @@ class Canvas(FigureCanvasQTAgg):
          qt_event: mouse wheel event.
         """
         scroll_val = qt_event.angleDelta().y()
-        ax = self._ani.figure.get_axes()[0]
-        if scroll_val == 120:
-            self._ani.scale_axes(ax, 0.9, 0.9)
-            self._ani.on_plot_view_changed()
-        elif scroll_val == -120:
-            self._ani.scale_axes(ax, 1.1, 1.1)
-            self._ani.on_plot_view_changed()
+        if scroll_val == 0:
+            return
+        # A step of 120 is one notch of a standard wheel.
+        factor = 0.9**(scroll_val/120.0)
+        scale, x_offset, y_offset = self._pending_zoom
+        # The point under the pointer in the view as it will be once
+        # the pending zoom is applied, which stays where it is.
+        xc, yc = self._mouse_coordinates_transform(qt_event.pos().x(),
+                                                   qt_event.pos().y())
+        xc, yc = scale*xc + x_offset, scale*yc + y_offset
+        self._pending_zoom = (factor*scale,
+                              factor*x_offset + (1.0 - factor)*xc,
+                              factor*y_offset + (1.0 - factor)*yc)
+        self._pending_events += 1
+        self._zoom_settle_timer.start()
+        self._ani.mark_dirty()
+
+    def _pan_distance(self, dx: int, dy: int) -> Tuple[float, float]:
+        """
+        Get how far to move the axes limits when the plot is
+        dragged by some distance in logical pixels.
+        """
+        ax = self.figure.get_axes()[0]
+        xlim, ylim = ax.get_xlim(), ax.get_ylim()
+        ratio = self.device_pixel_ratio
+        return (-dx*ratio*(xlim[1] - xlim[0])/ax.bbox.width,
+                dy*ratio*(ylim[1] - ylim[0])/ax.bbox.height)
+
+    def apply_view_changes(self) -> None:
+        """
+        Move and zoom the view by the amounts added up since the last
+        frame, and sample the new view once. This is called at
+        the start of every frame.
+        """
+        if self._pending_events == 0:
+            return
+        ax = self.figure.get_axes()[0]
+        if self._pending_pan != [0, 0]:
+            self._ani.move_axes(ax, *self._pan_distance(*self._pending_pan))
+        scale, x_offset, y_offset = self._pending_zoom
+        zoomed = (scale, x_offset, y_offset) != (1.0, 0.0, 0.0)
+        if abs(1.0 - scale) > 1e-12:
+            # Scaling about the point that the zoom leaves in place.
+            self._ani.scale_axes(ax, scale, scale,
+                                 (x_offset/(1.0 - scale),
+                                  y_offset/(1.0 - scale)))
+        elif zoomed:
+            self._ani.move_axes(ax, x_offset, y_offset)
+        self._ani.stats.increment("coalesced events",
+                                  self._pending_events - 1)
+        self._pending_pan = [0, 0]
+        self._pending_zoom = (1.0, 0.0, 0.0)
+        self._pending_events = 0
+        self._ani.on_plot_view_changed(coarse=zoomed)
+
+    def resizeEvent(self, qt_event: QtGui.QResizeEvent) -> None:
+        """
+        The canvas is resized. This also happens when the window
+        is moved to a screen with another pixel density.
+
+        Parameters:
+         qt_event: resize event.
+        """
+        FigureCanvasQTAgg.resizeEvent(self, qt_event)
+        self._ani.update_number_of_points()
+        self._ani.on_plot_view_changed()
+
+    def event(self, qt_event: QtCore.QEvent) -> bool:
+        """
+        Handle any event, adding the time it takes to the
+        events stage of the frame statistics.
+
+        Parameters:
+         qt_event: the event.
+        """
+        with self._ani.stats.measure("events"):
+            return FigureCanvasQTAgg.event(self, qt_event)
+
+    def paintEvent(self, qt_event: QtGui.QPaintEvent) -> None:
+        """
+        Paint the canvas, or the moved image of the plot while it is
+        dragged, adding the time it takes to the draw stage of the
+        frame statistics.
+
+        Parameters:
+         qt_event: paint event.
+        """
+        with self._ani.stats.measure("draw"):
+            if self._pan_preview is not None and self._paint_pan_preview():
+                return
+            FigureCanvasQTAgg.paintEvent(self, qt_event)
 
     def get_animation(self) -> PlottyAnimator:
         """
@@ -267,6 +484,15 @@ class Slider(QtWidgets.QSlider):
         """
         self._observers = slider_observers
 
+    def set_id(self, slider_id: Any) -> None:
+        """
+        Set the slider identification.
+
+        Parameters:
+         slider_id: slider identification.
+        """
+        self._slider_id = slider_id
+
     def set_number_of_ticks(self, number_of_ticks: int) -> None:
         """
         Set the total number of intervals in the slider.
@@ -295,6 +521,19 @@ class Slider(QtWidgets.QSlider):
         m = (lim[1] - lim[0])/(self.maximum() - self.minimum())
         return m*slider_val + lim[0]
 
+    def get_tick_values(self) -> list:
+        """
+        Get the value of each position of the slider, ordered from
+        the closest to the current position to the furthest.
+
+        Returns:
+         A list of the values.
+        """
+        current = self.value()
+        ticks = sorted(range(self.minimum(), self.maximum() + 1),
+                       key=lambda tick: abs(tick - current))
+        return [self._transform(tick) for tick in ticks]
+
     def set_slider(self, value: float) -> None:
         """
         Set a value for the slider.
@@ -385,6 +624,30 @@ class HorizontalSliderBox(QtWidgets.QGroupBox):
         """
         self._slider.set_slider(value)
 
+    def reconfigure(self, slider_id: Any,
+                    min_val: float, max_val: float,
+                    number_of_ticks: int, value: float) -> None:
+        """
+        Set up the box for another slider, without notifying the
+        observers of the slider.
+
+        Parameters:
+         slider_id: the id of the slider.
+         min_val: The lowest possible value that the slider can take.
+         max_val: The largest possible value that the slider can take.
+         number_of_ticks: total number of intervals.
+         value: the value to set the slider to.
+        """
+        self._slider.blockSignals(True)
+        try:
+            self._slider.set_id(slider_id)
+            self.set_range(min_val, max_val)
+            self.set_number_of_ticks(number_of_ticks)
+            self.set_slider(value)
+        finally:
+            self._slider.blockSignals(False)
+        self.on_slider_changed(self.get_slider_info())
+
     def set_observers(self,
                       slider_observers: list) -> None:
         """
@@ -425,6 +688,16 @@ class HorizontalSliderBox(QtWidgets.QGroupBox):
         """
         return self._slider.get_slider_info()
 
+    def get_tick_values(self) -> list:
+        """
+        Get the value of each position of the slider, ordered from
+        the closest to the current position to the furthest.
+
+        Returns:
+         A list of the values.
+        """
+        return self._slider.get_tick_values()
+
 
 class HorizontalEntryBox(QtWidgets.QGroupBox):
     """
@@ -484,7 +757,22 @@ class App(QtWidgets.QMainWindow):
         QtWidgets.QMainWindow.__init__(self)
         self.setWindowTitle("A simple GUI")
         self.sliders = []
-        self._setting_sliders = False
+        # Slider boxes that are hidden, to be reused when a function
+        # has more parameters.
+        self._spare_sliders = []
+        # Prefetch the curves for the last slider that was moved,
+        # once it has been still for a moment.
+        self._prefetch_index = None
+        self._prefetch_timer = QtCore.QTimer(self)
+        self._prefetch_timer.setSingleShot(True)
+        self._prefetch_timer.setInterval(200)
+        self._prefetch_timer.timeout.connect(self.prefetch_slider)
+        # Samples the view again once the sliders have stopped moving.
+        self._parameter_settle_timer = QtCore.QTimer(self)
+        self._parameter_settle_timer.setSingleShot(True)
+        self._parameter_settle_timer.setInterval(150)
+        self._parameter_settle_timer.timeout.connect(
+            self.on_parameters_settled)
         self.window = QtWidgets.QWidget(self)
         self.layout = QtWidgets.QHBoxLayout(self.window)
         rect = QtWidgets.QApplication.desktop().screenGeometry()
@@ -576,23 +864,23 @@ class App(QtWidgets.QMainWindow):
         Parameters:
          text: function expressed as a string.
         """
-        self._setting_sliders = True
-        self.destroy_sliders()
+        self._prefetch_index = None
         function_name = text
         ani = self.canvas.get_animation()
         ani.set_function(function_name)
         d = ani.function.get_enumerated_default_values()
-        for i in range(len(d)):
-            symbol = d[i][0]
-            value = d[i][1]
-            slider_box = HorizontalSliderBox(self, symbol)
-            self.control_widgets.addWidget(slider_box)
-            slider_box.set_range(-10.0, 10.0)
-            slider_box.set_number_of_ticks(201)
-            slider_box.set_observers([self])
-            slider_box.set_slider(value)
-            self.sliders.append(slider_box)
-        self._setting_sliders = False
+        # Lay the window out once, after every slider has been set up.
+        self.window.setUpdatesEnabled(False)
+        try:
+            self.set_number_of_sliders(len(d))
+            for i in range(len(d)):
+                symbol = d[i][0]
+                value = d[i][1]
+                self.sliders[i].reconfigure(symbol, -10.0, 10.0, 201, value)
+        finally:
+            self.window.setUpdatesEnabled(True)
+        # The sliders don't notify while being set up,
+        # so the parameters are set once here.
         self.on_slider_changed({})
 
     def on_slider_changed(self, slider_input: dict) -> None:
@@ -604,23 +892,61 @@ class App(QtWidgets.QMainWindow):
          about the slider.
         """
         params = []
-        if self.sliders != [] and not self._setting_sliders:
-            for slider in self.sliders:
-                info = slider.get_slider_info()
-                params.append(info['value'])
+        if self.sliders != []:
             ani = self.canvas.get_animation()
-            ani.set_parameters(params)
+            with ani.stats.measure("events"):
+                for i, slider in enumerate(self.sliders):
+                    info = slider.get_slider_info()
+                    params.append(info['value'])
+                    if info['id'] == slider_input.get('id'):
+                        self._prefetch_index = i
+                ani.set_parameters(params)
+                self._parameter_settle_timer.start()
+                if self._prefetch_index is not None:
+                    self._prefetch_timer.start()
 
-    def destroy_sliders(self) -> None:
+    def on_parameters_settled(self) -> None:
         """
-        Destroy the sliders.
+        Let the animation respond once the sliders have
+        stopped moving.
         """
-        while self.sliders != []:
+        self.canvas.get_animation().on_parameters_settled()
+
+    def prefetch_slider(self) -> None:
+        """
+        Start computing the curves for the positions of the
+        last slider that was moved.
+        """
+        i = self._prefetch_index
+        if i is not None and i < len(self.sliders):
+            ani = self.canvas.get_animation()
+            ani.prefetch_parameter(i, self.sliders[i].get_tick_values())
+
+    def set_number_of_sliders(self, number_of_sliders: int) -> None:
+        """
+        Show the given number of slider boxes. Boxes that are no
+        longer needed are hidden and kept for reuse, rather than
+        destroyed, and new boxes are only made when there are
+        no hidden ones left.
+
+        Parameters:
+         number_of_sliders: the number of slider boxes.
+        """
+        while len(self.sliders) > number_of_sliders:
             slider_box = self.sliders.pop()
-            self.control_widgets.removeWidget(slider_box)
-            self.layout.removeWidget(slider_box)
-            slider_box.destroy_slider()
-            slider_box.close()
+            slider_box.hide()
+            self._spare_sliders.append(slider_box)
+        while len(self.sliders) < number_of_sliders:
+            if self._spare_sliders != []:
+                # The last box hidden is the first one after the
+                # shown boxes in the layout, which keeps their order.
+                slider_box = self._spare_sliders.pop()
+                slider_box.show()
+            else:
+                slider_box = HorizontalSliderBox(self, "")
+                slider_box.set_observers([self])
+                self.control_widgets.addWidget(slider_box)
+            self.sliders.append(slider_box)
 
     def on_entry_returned(self, text: str) -> None:
         """
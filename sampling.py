@@ -0,0 +1,555 @@
+# Copyright (C) 2020 Mark (marl0ny)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Choosing where to sample a function so that its plot looks right
+at the current zoom level, without using more points than needed.
+"""
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Callable, Sequence, Tuple
+
+
+class AdaptiveSampler:
+    """
+    Sample a function on a coarse grid, then repeatedly add the
+    midpoint of each interval where the function differs from a
+    straight line by more than a tolerance in pixels. Every level of
+    refinement is evaluated as one array. An interval that still needs
+    refining once it is narrower than a fraction of a pixel is bisected
+    further towards its steepest part. If the change across it doesn't
+    shrink, it contains a jump or an asymptote, and NaN is inserted
+    there so that the plotted line is broken.
+
+    Attributes:
+     coarse_points [int]: the number of points in the initial grid.
+     max_points [int]: the maximum number of points.
+     tolerance [float]: the largest allowed error in pixels.
+     min_width [float]: the narrowest interval that is refined,
+                        in pixels.
+     jump_iterations [int]: the number of bisections used to
+                            tell a jump from a steep slope.
+
+    >>> sampler = AdaptiveSampler(coarse_points=9, max_points=1000)
+    >>> x, y = sampler.sample(lambda x: x, (), (0.0, 1.0), (0.0, 1.0),
+    ...                       (100.0, 100.0))
+    >>> len(x)
+    9
+    >>> x, y = sampler.sample(lambda x: np.sign(x), (), (-1.0, 2.0),
+    ...                       (-1.0, 1.0), (300.0, 200.0))
+    >>> int(np.sum(np.isnan(y)))
+    1
+    >>> bool(np.all(np.abs(x[np.isnan(y)]) < 0.01))
+    True
+    """
+
+    def __init__(self, coarse_points: int = 256, max_points: int = 1 << 14,
+                 tolerance: float = 0.5, min_width: float = 1.0/16.0
+                 ) -> None:
+        """
+        The initializer.
+
+        Parameters:
+         coarse_points: the number of points in the initial grid.
+         max_points: the maximum number of points.
+         tolerance: the largest allowed error in pixels.
+         min_width: the narrowest interval that is refined, in pixels.
+        """
+        self.coarse_points = coarse_points
+        self.max_points = max_points
+        self.tolerance = tolerance
+        self.min_width = min_width
+        self.jump_iterations = 24
+
+    def sample(self, function: Callable, params: Sequence[float],
+               xlim: Tuple[float, float], ylim: Tuple[float, float],
+               pixel_size: Tuple[float, float]
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sample a function over the visible range.
+
+        Parameters:
+         function: the function, called as function(x, *params).
+         params: the parameters of the function.
+         xlim: the visible range of x.
+         ylim: the visible range of y.
+         pixel_size: the width and height of the plot in pixels.
+
+        Returns:
+         The sampling points, and the values of the function
+         there with NaN where the line should be broken.
+        """
+        x_scale = pixel_size[0]/(xlim[1] - xlim[0])
+        y_scale = pixel_size[1]/abs(ylim[1] - ylim[0])
+        min_width = self.min_width/x_scale
+        x = np.linspace(xlim[0], xlim[1], self.coarse_points)
+        y = self._evaluate(function, x, params)
+        # Left endpoints of the intervals that are checked next.
+        candidates = np.arange(len(x) - 1)
+        breaks = []
+        while len(candidates) > 0 and len(x) < self.max_points:
+            left, right = x[candidates], x[candidates + 1]
+            mid = 0.5*(left + right)
+            y_mid = self._evaluate(function, mid, params)
+            y_line = 0.5*(y[candidates] + y[candidates + 1])
+            with np.errstate(invalid="ignore"):
+                error = np.abs(y_mid - y_line)*y_scale
+                # Intervals where the function stops or starts being
+                # defined are refined as well, to find where.
+                bad = (np.isnan(y_mid) != np.isnan(y_line))
+                refine = (error > self.tolerance) | bad
+            narrow = (right - left) < min_width
+            steep = np.flatnonzero(refine & narrow & ~bad)
+            if len(steep) > 0:
+                breaks.append(self._find_jumps(
+                    function, params, left[steep], right[steep],
+                    y[candidates[steep]], y[candidates[steep] + 1],
+                    y_scale))
+            refine &= ~narrow
+            if not np.any(refine):
+                break
+            # Keep within the point budget by refining the worst first.
+            budget = self.max_points - len(x)
+            indices = np.flatnonzero(refine)
+            if len(indices) > budget:
+                worst = np.argpartition(-np.nan_to_num(error[indices],
+                                                       nan=np.inf),
+                                        budget - 1)[:budget]
+                indices = np.sort(indices[worst])
+            x = np.insert(x, candidates[indices] + 1, mid[indices])
+            y = np.insert(y, candidates[indices] + 1, y_mid[indices])
+            # Each inserted point shifts the later intervals along by one.
+            new_left = candidates[indices] + np.arange(len(indices))
+            candidates = np.stack([new_left, new_left + 1],
+                                  axis=-1).reshape(-1)
+        breaks = np.concatenate(breaks) if breaks else np.empty(0)
+        if len(breaks) > 0:
+            positions = np.searchsorted(x, breaks)
+            x = np.insert(x, positions, breaks)
+            y = np.insert(y, positions, np.nan)
+        return x, y
+
+    def extend(self, function: Callable, params: Sequence[float],
+               x: np.ndarray, y: np.ndarray,
+               xlim: Tuple[float, float], ylim: Tuple[float, float],
+               pixel_size: Tuple[float, float]
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Update samples after the view has been moved without
+        being scaled. The samples that are still visible are kept,
+        and only the strips that have come into view are sampled.
+
+        Parameters:
+         function: the function, called as function(x, *params).
+         params: the parameters of the function.
+         x: the previous sampling points.
+         y: the previous values of the function.
+         xlim: the new visible range of x.
+         ylim: the new visible range of y.
+         pixel_size: the width and height of the plot in pixels.
+
+        Returns:
+         The new sampling points and values.
+
+        >>> sampler = AdaptiveSampler(coarse_points=11)
+        >>> x, y = sampler.sample(lambda x: x, (), (0.0, 1.0), (0.0, 1.0),
+        ...                       (100.0, 100.0))
+        >>> x, y = sampler.extend(lambda x: x, (), x, y, (0.5, 1.5),
+        ...                       (0.0, 1.0), (100.0, 100.0))
+        >>> float(x[0]), float(x[-1]), bool(np.all(x == y))
+        (0.5, 1.5, True)
+        """
+        # Keep one point on each side of the view so that
+        # the line reaches its edges.
+        start = max(np.searchsorted(x, xlim[0], side="right") - 1, 0)
+        end = min(np.searchsorted(x, xlim[1], side="left") + 1, len(x))
+        if start >= end - 1:
+            return self.sample(function, params, xlim, ylim, pixel_size)
+        x, y = x[start: end], y[start: end]
+        width = xlim[1] - xlim[0]
+        xs, ys = [x], [y]
+        for strip in ((xlim[0], x[0]), (x[-1], xlim[1])):
+            if strip[1] <= strip[0]:
+                continue
+            fraction = (strip[1] - strip[0])/width
+            strip_sampler = AdaptiveSampler(
+                max(2, int(np.ceil(fraction*self.coarse_points)) + 1),
+                max(2, int(fraction*self.max_points)),
+                self.tolerance, self.min_width)
+            strip_x, strip_y = strip_sampler.sample(
+                function, params, strip, ylim,
+                (fraction*pixel_size[0], pixel_size[1]))
+            # The ends of the strip are already in the kept samples.
+            if strip[0] == x[-1]:
+                xs.append(strip_x[1:])
+                ys.append(strip_y[1:])
+            else:
+                xs.insert(0, strip_x[:-1])
+                ys.insert(0, strip_y[:-1])
+        return np.concatenate(xs), np.concatenate(ys)
+
+    def _find_jumps(self, function: Callable, params: Sequence[float],
+                    left: np.ndarray, right: np.ndarray,
+                    y_left: np.ndarray, y_right: np.ndarray,
+                    y_scale: float) -> np.ndarray:
+        """
+        Bisect each interval, always keeping the half over which
+        the function changes the most. For a continuous function the
+        change goes to zero, while across a jump or an asymptote
+        it doesn't.
+
+        Returns:
+         The locations of the jumps.
+        """
+        for _ in range(self.jump_iterations):
+            mid = 0.5*(left + right)
+            y_mid = self._evaluate(function, mid, params)
+            with np.errstate(invalid="ignore"):
+                left_change = np.nan_to_num(np.abs(y_mid - y_left),
+                                            nan=np.inf)
+                right_change = np.nan_to_num(np.abs(y_right - y_mid),
+                                             nan=np.inf)
+            take_left = left_change >= right_change
+            right = np.where(take_left, mid, right)
+            y_right = np.where(take_left, y_mid, y_right)
+            left = np.where(take_left, left, mid)
+            y_left = np.where(take_left, y_left, y_mid)
+        with np.errstate(invalid="ignore"):
+            jump = ~(np.abs(y_right - y_left)*y_scale <= self.tolerance)
+        return 0.5*(left + right)[jump]
+
+    @staticmethod
+    def _evaluate(function: Callable, x: np.ndarray,
+                  params: Sequence[float]) -> np.ndarray:
+        """
+        Evaluate the function as a float array, with infinities
+        replaced by NaN.
+        """
+        y = np.empty(x.shape)
+        with np.errstate(all="ignore"):
+            y[...] = function(x, *params)
+        y[np.isinf(y)] = np.nan
+        return y
+
+
+class SampleBuffer:
+    """
+    Evenly spaced samples on a grid anchored at x = k*h, for
+    consecutive integers k. When the view is moved without changing
+    the spacing, the samples that are still visible are reused and
+    only the points that have come into view are evaluated,
+    so the cost depends on how far the view moved rather than
+    on the number of points.
+
+    Attributes:
+     spacing [float]: the grid spacing h.
+     x [np.ndarray]: the current sampling points.
+     y [np.ndarray]: the values of the function there.
+     evaluated [int]: the number of points evaluated by the last update.
+
+    >>> samples = SampleBuffer()
+    >>> x, y = samples.update(lambda x: 2.0*x, (0.0, 1.0), 11)
+    >>> samples.evaluated
+    11
+    >>> x, y = samples.update(lambda x: 2.0*x, (0.2, 1.2), 11)
+    >>> samples.evaluated, round(float(x[-1]), 12)
+    (2, 1.2)
+    >>> bool(np.allclose(y, 2.0*x))
+    True
+    """
+
+    def __init__(self) -> None:
+        """
+        The initializer.
+        """
+        self.spacing = None
+        self.x = None
+        self.y = None
+        self.evaluated = 0
+        self._first = None
+
+    def invalidate(self) -> None:
+        """
+        Forget the samples, which must be done whenever
+        the function or its parameters change.
+        """
+        self.x = None
+        self.y = None
+        self._first = None
+
+    def update(self, evaluate: Callable[[np.ndarray], np.ndarray],
+               xlim: Tuple[float, float],
+               n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get samples covering the view.
+
+        Parameters:
+         evaluate: evaluates the function over an array.
+         xlim: the visible range of x.
+         n: the number of points across the view.
+
+        Returns:
+         The sampling points and the values of the function there.
+        """
+        h = (xlim[1] - xlim[0])/(n - 1)
+        if self.spacing is None or abs(h - self.spacing) > 1e-9*h:
+            self.invalidate()
+            self.spacing = h
+        h = self.spacing
+        first = int(np.floor(xlim[0]/h + 1e-9))
+        last = int(np.ceil(xlim[1]/h - 1e-9))
+        x = np.arange(first, last + 1)*h
+        y = np.empty(len(x))
+        start, end = first, first
+        if self.x is not None:
+            # The range of k that is in both the old and new samples.
+            start = max(first, self._first)
+            end = min(last + 1, self._first + len(self.x))
+        if start < end:
+            old = self.y[start - self._first: end - self._first]
+            y[start - first: end - first] = old
+            if start > first:
+                y[: start - first] = evaluate(x[: start - first])
+            if end <= last:
+                y[end - first:] = evaluate(x[end - first:])
+            self.evaluated = len(x) - (end - start)
+        else:
+            y[...] = evaluate(x)
+            self.evaluated = len(x)
+        self.x, self.y, self._first = x, y, first
+        return x, y
+
+
+class TileCache:
+    """
+    Evenly spaced samples stored in tiles, so that views that were
+    sampled before, or that overlap them, don't need to be evaluated
+    again. The spacing of the samples is a power of two, so that each
+    zoom level has its own fixed grid x = k*2**level, and each
+    tile holds tile_points consecutive points of one level. The least
+    recently used tiles are dropped when the total size of the
+    tiles exceeds max_bytes. Adaptive samples are kept in tiles
+    as well, see sample_adaptive.
+
+    Attributes:
+     max_bytes [int]: the maximum total size of the tiles.
+     tile_points [int]: the number of points in each tile, and the
+                        width in pixels of each adaptive tile.
+     hits [int]: number of tiles that were found in the cache.
+     misses [int]: number of tiles that had to be evaluated.
+
+    >>> tiles = TileCache(1 << 20, tile_points=4)
+    >>> x, y = tiles.sample(lambda x: 2.0*x, "2*x", (0.0, 1.0), 5)
+    >>> x
+    array([0.  , 0.25, 0.5 , 0.75, 1.  ])
+    >>> tiles.misses
+    2
+    >>> x, y = tiles.sample(lambda x: 2.0*x, "2*x", (0.1, 0.9), 4)
+    >>> tiles.hits, bool(np.all(y == 2.0*x))
+    (2, True)
+    """
+
+    def __init__(self, max_bytes: int, tile_points: int = 256) -> None:
+        """
+        The initializer.
+
+        Parameters:
+         max_bytes: the maximum total size of the tiles.
+         tile_points: the number of points in each tile.
+        """
+        self.max_bytes = max_bytes
+        self.tile_points = tile_points
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        # The size in bytes of each tile.
+        self._sizes = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def clear(self) -> None:
+        """
+        Drop every tile.
+        """
+        with self._lock:
+            self._tiles.clear()
+            self._sizes.clear()
+            self._nbytes = 0
+
+    @staticmethod
+    def level(xlim: Tuple[float, float], n: int) -> int:
+        """
+        Get the zoom level for sampling a range with at least n points.
+
+        >>> TileCache.level((0.0, 1.0), 5)
+        -2
+        """
+        return int(np.floor(np.log2((xlim[1] - xlim[0])/(n - 1))))
+
+    def sample(self, evaluate: Callable[[np.ndarray], np.ndarray],
+               key: Any, xlim: Tuple[float, float],
+               n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get samples covering a range, with between n and 2n points
+        across it. Tiles that aren't cached are evaluated together
+        in one call.
+
+        Parameters:
+         evaluate: evaluates the function over an array.
+         key: identifies the function and its parameters, and
+         must be hashable.
+         xlim: the range.
+         n: the least number of points across the range.
+
+        Returns:
+         The sampling points and the values of the function there.
+        """
+        level = self.level(xlim, n)
+        h = 2.0**level
+        size = self.tile_points
+        first = int(np.floor(xlim[0]/h))
+        last = int(np.ceil(xlim[1]/h))
+        indices = range(first//size, last//size + 1)
+        with self._lock:
+            tiles = [self._tiles.get((key, level, j)) for j in indices]
+            for j, tile in zip(indices, tiles):
+                if tile is not None:
+                    self._tiles.move_to_end((key, level, j))
+        missing = [i for i, tile in enumerate(tiles) if tile is None]
+        self.hits += len(tiles) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            tile_starts = (indices[0] + np.array(missing))*size
+            k = (tile_starts[:, np.newaxis] + np.arange(size)).reshape(-1)
+            values = np.empty(len(k))
+            values[...] = evaluate(k*h)
+            with self._lock:
+                for m, i in enumerate(missing):
+                    # A view of values would keep all of it alive
+                    # while only its own size counts to max_bytes.
+                    tile = values[m*size: (m + 1)*size].copy()
+                    tiles[i] = tile
+                    self._store((key, level, indices[i]), tile,
+                                tile.nbytes)
+        start = first - indices[0]*size
+        y = np.concatenate(tiles)[start: start + last - first + 1]
+        x = np.arange(first, last + 1)*h
+        return x, y
+
+    def sample_adaptive(self, sampler: AdaptiveSampler, function: Callable,
+                        params: Sequence[float], key: Any,
+                        xlim: Tuple[float, float], ylim: Tuple[float, float],
+                        pixel_size: Tuple[float, float]
+                        ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sample a function adaptively over a range, one tile at a time.
+        The size of a pixel is rounded down to a power of two in each
+        direction, which gives each zoom level its own grid of tiles
+        that are tile_points pixels wide. Tiles that aren't cached are
+        sampled with the sampler as if they were on their own.
+
+        Parameters:
+         sampler: the sampler, whose number of points are for
+         the whole range.
+         function: the function, called as function(x, *params).
+         params: the parameters of the function.
+         key: identifies the function and its parameters, and
+         must be hashable.
+         xlim: the range.
+         ylim: the visible range of y.
+         pixel_size: the width and height of the plot in pixels.
+
+        Returns:
+         The sampling points, from just before the range to just
+         after it, and the values of the function with NaN where
+         the line should be broken.
+
+        >>> tiles = TileCache(1 << 20, tile_points=64)
+        >>> sampler = AdaptiveSampler(coarse_points=16)
+        >>> step = lambda x: np.sign(x - 0.3)
+        >>> x, y = tiles.sample_adaptive(sampler, step, (), "step",
+        ...                              (-1.0, 2.0), (-1.0, 1.0),
+        ...                              (300.0, 200.0))
+        >>> int(np.sum(np.isnan(y))), bool(x[0] <= -1.0 and x[-1] >= 2.0)
+        (1, True)
+        >>> misses = tiles.misses
+        >>> x, y = tiles.sample_adaptive(sampler, step, (), "step",
+        ...                              (-0.8, 2.2), (-1.0, 1.0),
+        ...                              (300.0, 200.0))
+        >>> tiles.misses == misses
+        True
+        """
+        x_level = int(np.floor(np.log2((xlim[1] - xlim[0])/pixel_size[0])))
+        y_level = int(np.floor(np.log2(abs(ylim[1] - ylim[0])
+                                       /pixel_size[1])))
+        pixel_width, pixel_height = 2.0**x_level, 2.0**y_level
+        width = self.tile_points*pixel_width
+        # The fraction of the range that a tile covers.
+        fraction = self.tile_points/pixel_size[0]
+        tile_sampler = AdaptiveSampler(
+            max(2, int(np.ceil(fraction*sampler.coarse_points)) + 1),
+            max(2, int(fraction*sampler.max_points)),
+            sampler.tolerance, sampler.min_width)
+        settings = (tile_sampler.coarse_points, tile_sampler.max_points,
+                    sampler.tolerance, sampler.min_width)
+        indices = range(int(np.floor(xlim[0]/width)),
+                        int(np.floor(xlim[1]/width)) + 1)
+        tile_keys = [(key, "adaptive", settings, x_level, y_level, j)
+                     for j in indices]
+        with self._lock:
+            tiles = [self._tiles.get(tile_key) for tile_key in tile_keys]
+            for tile_key, tile in zip(tile_keys, tiles):
+                if tile is not None:
+                    self._tiles.move_to_end(tile_key)
+        missing = [i for i, tile in enumerate(tiles) if tile is None]
+        self.hits += len(tiles) - len(missing)
+        self.misses += len(missing)
+        for i in missing:
+            j = indices[i]
+            tiles[i] = tile_sampler.sample(
+                function, params, (j*width, (j + 1)*width),
+                (0.0, pixel_height), (self.tile_points, 1.0))
+        if missing:
+            with self._lock:
+                for i in missing:
+                    x, y = tiles[i]
+                    self._store(tile_keys[i], tiles[i], x.nbytes + y.nbytes)
+        # Neighbouring tiles share their end points.
+        x = np.concatenate([tiles[0][0]] + [t[0][1:] for t in tiles[1:]])
+        y = np.concatenate([tiles[0][1]] + [t[1][1:] for t in tiles[1:]])
+        start = max(np.searchsorted(x, xlim[0], side="right") - 1, 0)
+        end = min(np.searchsorted(x, xlim[1], side="left") + 1, len(x))
+        return x[start: end], y[start: end]
+
+    def _store(self, tile_key: tuple, tile: Any, nbytes: int) -> None:
+        """
+        Add a tile of the given size in bytes, dropping the least
+        recently used tiles if the cache is full. The lock must be held.
+        """
+        if tile_key in self._tiles:
+            self._nbytes -= self._sizes.pop(tile_key)
+            del self._tiles[tile_key]
+        self._tiles[tile_key] = tile
+        self._sizes[tile_key] = nbytes
+        self._nbytes += nbytes
+        while self._nbytes > self.max_bytes and self._tiles:
+            old_key, _ = self._tiles.popitem(last=False)
+            self._nbytes -= self._sizes.pop(old_key)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
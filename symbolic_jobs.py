@@ -0,0 +1,236 @@
+# Copyright (C) 2020 Mark (marl0ny)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Symbolic differentiation and integration in a separate process,
+so that a slow sympy computation doesn't freeze the GUI and
+can be cancelled.
+"""
+import multiprocessing
+from multiprocessing.connection import Connection
+from time import perf_counter, sleep
+from typing import Union
+
+
+# The operations that can be run, by name.
+operations = ("derivative", "antiderivative")
+
+
+def _run(conn: Connection, operation: str,
+         expr_repr: str, var_name: str) -> None:
+    """
+    Entry point of the worker process. Sends back either
+    ("ok", srepr of the result) or ("error", message).
+
+    Parameters:
+     conn: the child end of the pipe.
+     operation: the name of the operation.
+     expr_repr: the expression, as given by srepr.
+     var_name: the name of the variable.
+    """
+    # Only import sympy in the worker.
+    from sympy import diff, integrate, srepr, Symbol
+    from sympy.parsing.sympy_parser import parse_expr
+    try:
+        expr = parse_expr(expr_repr)
+        var = Symbol(var_name)
+        if operation == "derivative":
+            result = diff(expr, var)
+        else:
+            result = integrate(expr, var)
+        conn.send(("ok", srepr(result)))
+    except Exception as e:
+        conn.send(("error", "%s: %s" % (type(e).__name__, e)))
+    finally:
+        conn.close()
+
+
+class SymbolicJob:
+    """
+    A derivative or antiderivative computed by sympy in another process.
+    Nothing here blocks except wait: poll is meant to be called
+    periodically, for example from a timer in the GUI. Once the job
+    has finished its worker process is stopped, and exited is then
+    called periodically until the process has exited.
+
+    Attributes:
+     operation [str]: either "derivative" or "antiderivative".
+     timeout [float]: seconds after which the job is cancelled,
+                      or None for no limit.
+     status [str]: "running", "done", "error", "cancelled" or "timeout".
+     result [str]: the srepr of the result, once done.
+     error [str]: the error message, if the job failed.
+
+    >>> from sympy import srepr, parse_expr
+    >>> job = SymbolicJob("derivative", srepr(parse_expr("a*x**2")), "x")
+    >>> job.start()
+    >>> job.wait(60.0)
+    'done'
+    >>> parse_expr(job.result)
+    2*a*x
+    >>> job = SymbolicJob("antiderivative", srepr(parse_expr("x")), "x",
+    ...                   timeout=0.0)
+    >>> job.start()
+    >>> job.poll()
+    'timeout'
+    >>> while not job.exited():
+    ...     sleep(0.01)
+    """
+
+    def __init__(self, operation: str, expr_repr: str, var_name: str,
+                 timeout: Union[float, None] = None) -> None:
+        """
+        The initializer. The job starts when start is called.
+
+        Parameters:
+         operation: either "derivative" or "antiderivative".
+         expr_repr: the expression, as given by srepr.
+         var_name: the name of the variable.
+         timeout: seconds after which the job is cancelled.
+        """
+        if operation not in operations:
+            raise ValueError("Unknown operation %s" % operation)
+        self.operation = operation
+        self.timeout = timeout
+        self.status = "running"
+        self.result = None
+        self.error = None
+        self._args = (operation, expr_repr, var_name)
+        self._process = None
+        self._conn = None
+        self._start_time = None
+        self._finish_time = None
+
+    def start(self) -> None:
+        """
+        Start the worker process. The spawn start method is used
+        since forking a process that runs Qt is unsafe.
+        """
+        context = multiprocessing.get_context("spawn")
+        self._conn, child_conn = context.Pipe(duplex=False)
+        self._process = context.Process(target=_run,
+                                        args=(child_conn, *self._args),
+                                        daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._start_time = perf_counter()
+
+    def elapsed(self) -> float:
+        """
+        Get the number of seconds since the job was started.
+        """
+        if self._start_time is None:
+            return 0.0
+        return perf_counter() - self._start_time
+
+    def poll(self) -> str:
+        """
+        Check on the job without blocking.
+
+        Returns:
+         The status of the job.
+        """
+        if self.status != "running" or self._conn is None:
+            return self.status
+        try:
+            ready = self._conn.poll()
+        except (OSError, EOFError):
+            ready = False
+        if ready:
+            try:
+                kind, value = self._conn.recv()
+            except (OSError, EOFError) as e:
+                kind, value = "error", str(e)
+            if kind == "ok":
+                self.result = value
+                self._finish("done")
+            else:
+                self.error = value
+                self._finish("error")
+        elif not self._process.is_alive():
+            self.error = "worker exited with code %s" % (
+                self._process.exitcode)
+            self._finish("error")
+        elif self.timeout is not None and self.elapsed() >= self.timeout:
+            self._finish("timeout")
+        return self.status
+
+    def wait(self, timeout: Union[float, None] = None,
+             interval: float = 0.01) -> str:
+        """
+        Block until the job has finished.
+
+        Parameters:
+         timeout: the longest time to wait in seconds. This doesn't
+         cancel the job.
+         interval: how often to check on the job.
+
+        Returns:
+         The status of the job.
+        """
+        t0 = perf_counter()
+        while self.poll() == "running":
+            if timeout is not None and perf_counter() - t0 >= timeout:
+                break
+            sleep(interval)
+        return self.status
+
+    def cancel(self) -> None:
+        """
+        Stop the job if it is still running.
+        """
+        if self.status == "running":
+            self._finish("cancelled")
+
+    def exited(self, kill_after: float = 1.0) -> bool:
+        """
+        Check without blocking whether the worker process has exited
+        since the job finished, and clean up after it if it has.
+
+        Parameters:
+         kill_after: seconds after the job finished after which
+         the process is killed if it is still running.
+
+        Returns:
+         Whether the process has exited.
+        """
+        if self._process is None:
+            return True
+        if self._process.is_alive():
+            if (self._finish_time is not None and
+                    perf_counter() - self._finish_time >= kill_after):
+                self._process.kill()
+            return False
+        self._process.close()
+        self._process = None
+        return True
+
+    def _finish(self, status: str) -> None:
+        """
+        Set the final status and stop the worker process, without
+        waiting for it to exit, see exited.
+        """
+        self.status = status
+        self._finish_time = perf_counter()
+        if self._process is not None and self._process.is_alive():
+            self._process.terminate()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()